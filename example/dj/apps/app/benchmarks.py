@@ -0,0 +1,125 @@
+import string
+import time
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+
+from verification_token.generators import batch_random_string_generator, generate_many, random_string_generator
+from verification_token.models import VerificationToken
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+def measure(func, iterations):
+    """
+    Calls func iterations times and returns throughput, p50/p99 latency in milliseconds and queries per call.
+    """
+    latencies = []
+    with CaptureQueriesContext(connection) as context:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            func()
+            latencies.append(time.perf_counter() - start)
+    return {
+        'iterations': iterations,
+        'ops_per_second': iterations / sum(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'queries_per_op': len(context.captured_queries) / iterations,
+    }
+
+
+def seed_tokens(size, object_count=100000):
+    """
+    Inserts size tokens of users directly with SQL (SQLite only). Every fourth token is inactive, one third of tokens
+    has no expiration, the rest expire in range of +-500 minutes.
+    """
+    VerificationToken.objects.all().delete()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            WITH RECURSIVE seq(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM seq WHERE x < %s)
+            INSERT INTO verification_token_verificationtoken
+                (created_at, content_type_id, object_id, key, expires_at, slug, is_active, is_key_scoped, generation)
+            SELECT
+                datetime('now', '-' || (x %% 10000) || ' minutes'),
+                %s,
+                'seed' || (x %% %s),
+                'SEED' || x,
+                CASE WHEN x %% 3 = 0 THEN NULL ELSE datetime('now', '+' || (x %% 1000 - 500) || ' minutes') END,
+                CASE WHEN x %% 2 = 0 THEN 'slug' ELSE NULL END,
+                x %% 4 != 0,
+                0,
+                0
+            FROM seq
+            """,
+            [size, ContentType.objects.get_for_model(User).pk, object_count]
+        )
+        cursor.execute('ANALYZE')
+
+
+def seed_exhausted_keyspace(content_type, keyspace_size, fill_ratio):
+    """
+    Inserts tokens with numeric keys which fill fill_ratio of the keyspace of keys with the same length.
+    """
+    key_length = len(str(keyspace_size - 1))
+    VerificationToken.objects.bulk_create([
+        VerificationToken(content_type=content_type, object_id='exhausted', key=str(i).zfill(key_length))
+        for i in range(int(keyspace_size * fill_ratio))
+    ], batch_size=500)
+    return key_length
+
+
+def measure_key_generator(generator, count, iterations):
+    """
+    Measures generating of count keys with the default length and alphabet, adds number of keys per second.
+    """
+    results = measure(lambda: generate_many(generator, count), iterations)
+    results['keys_per_second'] = results['ops_per_second'] * count
+    return results
+
+
+def run_benchmarks(size, iterations):
+    seed_tokens(size)
+    user = User.objects.create_user('benchmark-{}'.format(size))
+    content_type = ContentType.objects.get_for_model(User)
+    results = {}
+
+    results['deactivate_and_create'] = measure(
+        lambda: VerificationToken.objects.deactivate_and_create(user), iterations
+    )
+    with override_settings(VERIFICATION_TOKEN_OPTIMISTIC_KEY_GENERATION=True):
+        results['deactivate_and_create_optimistic'] = measure(
+            lambda: VerificationToken.objects.deactivate_and_create(user), iterations
+        )
+    results['get_active_or_create'] = measure(lambda: VerificationToken.objects.get_active_or_create(user), iterations)
+
+    key = VerificationToken.objects.deactivate_and_create(user).key
+    results['exists_valid'] = measure(lambda: VerificationToken.objects.exists_valid(user, key), iterations)
+    results['exists_valid_invalid_key'] = measure(
+        lambda: VerificationToken.objects.exists_valid(user, 'invalid'), iterations
+    )
+    results['deactivate'] = measure(lambda: VerificationToken.objects.deactivate(user), iterations)
+
+    key_length = seed_exhausted_keyspace(content_type, 10000, 0.9)
+    results['generate_key_exhausted_keyspace'] = measure(
+        lambda: VerificationToken.generate_key(length=key_length, allowed_chars=string.digits), iterations
+    )
+
+    results['random_string_generator_1000_keys'] = measure_key_generator(random_string_generator, 1000, iterations)
+    results['batch_random_string_generator_1000_keys'] = measure_key_generator(
+        batch_random_string_generator, 1000, iterations
+    )
+
+    results['clean_verification_tokens'] = measure(
+        lambda: call_command('clean_verification_tokens', stdout=StringIO()), 1
+    )
+    return results
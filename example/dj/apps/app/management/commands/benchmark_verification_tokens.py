@@ -0,0 +1,48 @@
+import json
+import platform
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases
+
+from app.benchmarks import run_benchmarks
+
+
+class Command(BaseCommand):
+
+    help = 'Benchmark verification token operations in a temporary SQLite test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10000],
+                            help='Numbers of tokens seeded to the table before the benchmarks (e.g. 10000 1000000)')
+        parser.add_argument('--iterations', type=int, default=200, help='Number of calls of every operation')
+        parser.add_argument('--output', help='Path to the JSON file with results')
+
+    def handle(self, **options):
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            results = {
+                'django': django.get_version(),
+                'python': platform.python_version(),
+                'database': connection.vendor,
+                'sizes': {},
+            }
+            for size in options['sizes']:
+                results['sizes'][size] = size_results = run_benchmarks(size, options['iterations'])
+                for operation, operation_results in size_results.items():
+                    self.stdout.write(
+                        '{size} tokens, {operation}: {ops_per_second:.0f} ops/s, p50 {p50_ms:.3f} ms, '
+                        'p99 {p99_ms:.3f} ms, {queries_per_op:.2f} queries/op'.format(
+                            size=size, operation=operation, **operation_results
+                        ) + (
+                            ', {:.0f} keys/s'.format(operation_results['keys_per_second'])
+                            if 'keys_per_second' in operation_results else ''
+                        )
+                    )
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
@@ -1,2 +1,8 @@
+from .async_api import *
+from .backends import *
 from .commands import *
+from .concurrency import *
+from .indexes import *
+from .metrics import *
 from .models import *
+from .queries import *
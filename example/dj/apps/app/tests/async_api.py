@@ -0,0 +1,87 @@
+import asyncio
+from unittest.mock import patch
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.test import override_settings
+
+from germanium.test_cases.default import GermaniumTestCase
+from germanium.tools import assert_equal, assert_false, assert_true
+from verification_token.models import VerificationToken
+
+from .base import BaseTestCaseMixin
+
+
+__all__ = (
+    'AsyncTokenTestCase',
+)
+
+
+class AsyncTokenTestCase(BaseTestCaseMixin, GermaniumTestCase):
+
+    async def test_verification_token_should_be_created_and_old_one_should_be_deactivated_async(self):
+        user = await sync_to_async(self.create_user)()
+        token1 = await VerificationToken.objects.adeactivate_and_create(user)
+        token2 = await VerificationToken.objects.adeactivate_and_create(user)
+        await token1.arefresh_from_db()
+        assert_false(token1.is_active)
+        assert_true(token2.is_valid)
+        assert_true(await VerificationToken.objects.aexists_valid(user, token2.key))
+        assert_false(await VerificationToken.objects.aexists_valid(user, token1.key))
+
+        await VerificationToken.objects.adeactivate(user)
+        assert_false(await VerificationToken.objects.aexists_valid(user, token2.key))
+
+    async def test_verification_token_get_active_or_create_should_return_existing_token_async(self):
+        user = await sync_to_async(self.create_user)()
+        token = await VerificationToken.objects.aget_active_or_create(user, slug='a')
+        assert_equal(await VerificationToken.objects.aget_active_or_create(user, slug='a'), token)
+
+    async def test_verification_token_should_be_consumed_only_once_async(self):
+        user = await sync_to_async(self.create_user)()
+        token = await VerificationToken.objects.adeactivate_and_create(user, extra_data={'a': 1})
+        results = await asyncio.gather(*(VerificationToken.objects.aconsume(user, token.key) for _ in range(5)))
+        assert_equal(sorted(results), [False] * 4 + [True])
+
+        token = await VerificationToken.objects.adeactivate_and_create(user, extra_data={'a': 1})
+        assert_equal(await VerificationToken.objects.aconsume(user, token.key, return_extra_data=True),
+                     (True, {'a': 1}))
+
+    async def test_verification_tokens_should_be_issued_concurrently(self):
+        users = [
+            await sync_to_async(User.objects.create_user)('user{}'.format(i)) for i in range(10)
+        ]
+        tokens = await asyncio.gather(*(
+            VerificationToken.objects.adeactivate_and_create(user, slug='a') for user in users
+        ))
+        assert_equal(len({token.key for token in tokens}), 10)
+        for user in users:
+            assert_equal(await (await VerificationToken.objects.afilter_active_tokens(user, slug='a')).acount(), 1)
+
+    @override_settings(VERIFICATION_TOKEN_VALIDITY_CACHE=True)
+    async def test_validity_cache_should_be_invalidated_async(self):
+        await cache.aclear()
+        user = await sync_to_async(self.create_user)()
+        token = await VerificationToken.objects.adeactivate_and_create(user)
+        assert_true(await VerificationToken.objects.aexists_valid(user, token.key))
+        assert_true(await VerificationToken.objects.aconsume(user, token.key))
+        assert_false(await VerificationToken.objects.aexists_valid(user, token.key))
+
+        token = await VerificationToken.objects.adeactivate_and_create(user)
+        assert_true(await VerificationToken.objects.aexists_valid(user, token.key))
+        await VerificationToken.objects.adeactivate(user)
+        assert_false(await VerificationToken.objects.aexists_valid(user, token.key))
+
+    async def test_cached_content_type_should_be_returned_without_thread_switch(self):
+        user = await sync_to_async(self.create_user)()
+        await sync_to_async(ContentType.objects.clear_cache)()
+        # content type is loaded in the thread on cache miss
+        content_type = await VerificationToken.objects._aget_content_type(user)
+        assert_equal(content_type.model_class(), User)
+
+        with patch('verification_token.models.sync_to_async') as sync_to_async_mock:
+            assert_equal(await VerificationToken.objects._aget_content_type(user), content_type)
+            assert_equal(await VerificationToken.objects._aget_content_type(User), content_type)
+        assert_false(sync_to_async_mock.called)
@@ -0,0 +1,169 @@
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import override_settings
+from django.utils import timezone
+
+from freezegun import freeze_time
+from germanium.decorators import data_consumer
+from germanium.test_cases.default import GermaniumTestCase
+from germanium.tools import (assert_equal, assert_false, assert_is_instance, assert_is_none, assert_raises,
+                             assert_true)
+from verification_token.backends import get_backend
+from verification_token.backends.cache import CacheTokenBackend
+from verification_token.backends.orm import ORMTokenBackend
+from verification_token.backends.signed import SignedTokenBackend
+from verification_token.models import VerificationToken
+
+from .base import BaseTestCaseMixin
+
+
+__all__ = (
+    'SignedTokenBackendTestCase',
+    'CacheTokenBackendTestCase',
+    'BackendSettingTestCase',
+)
+
+
+class SignedTokenBackendTestCase(BaseTestCaseMixin, GermaniumTestCase):
+
+    backend = SignedTokenBackend()
+
+    @data_consumer('create_user')
+    def test_signed_token_should_be_issued_without_database_write(self, user):
+        self.backend.deactivate_and_create(user, deactivate_old_tokens=False)
+        with self.assertNumQueries(1):
+            token = self.backend.deactivate_and_create(user, slug='a', deactivate_old_tokens=False)
+        assert_equal(VerificationToken.objects.count(), 0)
+        assert_true(token.is_valid)
+        assert_true(self.backend.exists_valid(user, token.key, slug='a'))
+        assert_false(self.backend.exists_valid(user, token.key, slug='b'))
+        assert_false(self.backend.exists_valid(user, token.key[:-1], slug='a'))
+        assert_false(self.backend.exists_valid(User.objects.create_user('user2'), token.key, slug='a'))
+
+    @data_consumer('create_user')
+    def test_signed_tokens_should_be_revoked_with_generation_counter(self, user):
+        token_a = self.backend.deactivate_and_create(user, slug='a')
+        token_b = self.backend.deactivate_and_create(user, slug='b')
+        new_token_a = self.backend.deactivate_and_create(user, slug='a')
+        assert_false(self.backend.exists_valid(user, token_a.key, slug='a'))
+        assert_true(self.backend.exists_valid(user, new_token_a.key, slug='a'))
+        assert_true(self.backend.exists_valid(user, token_b.key, slug='b'))
+
+        self.backend.deactivate(user, slug='a')
+        assert_false(self.backend.exists_valid(user, new_token_a.key, slug='a'))
+
+    @data_consumer('create_user')
+    def test_signed_token_revocation_should_write_generation_with_one_query(self, user):
+        self.backend.deactivate_and_create(user, slug='a')
+        with self.assertNumQueries(1):
+            token = self.backend.deactivate_and_create(user, slug='a')
+        assert_true(self.backend.exists_valid(user, token.key, slug='a'))
+        assert_equal(self.backend.deactivate(user, slug='a'), 3)
+        assert_false(self.backend.exists_valid(user, token.key, slug='a'))
+        assert_true(self.backend.get_token(token.key).check_key(token.key))
+        assert_false(self.backend.get_token(token.key).check_key(token.key[:-1]))
+        assert_false(self.backend.get_token(token.key).check_key(None))
+
+    @data_consumer('create_user')
+    def test_signed_token_should_expire(self, user):
+        token = self.backend.deactivate_and_create(user, expiration_in_minutes=10)
+        token_without_expiration = self.backend.deactivate_and_create(
+            user, expiration_in_minutes=None, deactivate_old_tokens=False
+        )
+        with freeze_time(timezone.now() + timedelta(minutes=11)):
+            assert_false(self.backend.exists_valid(user, token.key))
+            assert_true(self.backend.exists_valid(user, token_without_expiration.key))
+
+    @data_consumer('create_user')
+    def test_signed_token_should_contain_extra_data(self, user):
+        token = self.backend.deactivate_and_create(user, slug='a', extra_data={'a': 1})
+        loaded_token = self.backend.get_token(token.key)
+        assert_equal(loaded_token.get_extra_data(), {'a': 1})
+        assert_equal(loaded_token.object_id, str(user.pk))
+        assert_equal(loaded_token.slug, 'a')
+        assert_equal(int(loaded_token.expires_at.timestamp()), int(token.expires_at.timestamp()))
+        assert_is_none(self.backend.get_token('invalid'))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CacheTokenBackendTestCase(BaseTestCaseMixin, GermaniumTestCase):
+
+    backend = CacheTokenBackend()
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    @data_consumer('create_user')
+    def test_cache_token_should_be_created_and_old_one_should_be_deactivated(self, user):
+        with self.assertNumQueries(0):
+            token1 = self.backend.deactivate_and_create(user)
+        assert_true(token1.is_valid)
+        assert_true(self.backend.exists_valid(user, token1.key))
+        token2 = self.backend.deactivate_and_create(user)
+        assert_false(self.backend.exists_valid(user, token1.key))
+        assert_true(self.backend.exists_valid(user, token2.key))
+        assert_equal(VerificationToken.objects.count(), 0)
+
+    @data_consumer('create_user')
+    def test_cache_tokens_should_be_filtered_by_object_and_slug(self, user):
+        token_a = self.backend.deactivate_and_create(user, slug='a', extra_data={'a': 1})
+        token_b = self.backend.deactivate_and_create(user, slug='b')
+        assert_equal([token.key for token in self.backend.filter_active_tokens(user, slug='a')], [token_a.key])
+        assert_equal(self.backend.filter_active_tokens(user, slug='a')[0].get_extra_data(), {'a': 1})
+        assert_false(self.backend.exists_valid(user, token_a.key, slug='b'))
+        assert_false(self.backend.exists_valid(User.objects.create_user('user2'), token_a.key, slug='a'))
+
+        self.backend.deactivate(user, slug='a')
+        assert_equal(self.backend.filter_active_tokens(user, slug='a'), [])
+        assert_equal([token.key for token in self.backend.filter_active_tokens(user, slug='b')], [token_b.key])
+
+    @data_consumer('create_user')
+    def test_cache_token_should_expire(self, user):
+        token = self.backend.deactivate_and_create(user, expiration_in_minutes=10)
+        with freeze_time(timezone.now() + timedelta(minutes=11)):
+            assert_false(self.backend.exists_valid(user, token.key))
+            assert_equal(self.backend.filter_active_tokens(user), [])
+
+    @data_consumer('create_user')
+    def test_cache_token_get_active_or_create_should_return_existing_token(self, user):
+        token = self.backend.deactivate_and_create(user)
+        assert_equal(self.backend.get_active_or_create(user).key, token.key)
+        self.backend.deactivate(user)
+        assert_true(self.backend.get_active_or_create(user).key != token.key)
+
+    @data_consumer('create_user')
+    def test_cache_token_should_be_consumed_only_once(self, user):
+        token = self.backend.deactivate_and_create(user)
+        other_token = self.backend.deactivate_and_create(user, deactivate_old_tokens=False)
+        assert_true(self.backend.consume(user, token.key))
+        assert_false(self.backend.consume(user, token.key))
+        assert_false(self.backend.exists_valid(user, token.key))
+        assert_equal(list(self.backend._get_index(*self.backend._get_object_lookup(user), None)), [other_token.key])
+
+    @data_consumer('create_user')
+    def test_cache_token_should_be_deactivated_only_by_its_object_and_slug(self, user):
+        other_user = User.objects.create_user('other')
+        token = self.backend.deactivate_and_create(user, slug='a')
+        self.backend.deactivate(other_user, slug='a', key=token.key)
+        self.backend.deactivate(user, slug='b', key=token.key)
+        assert_true(self.backend.exists_valid(user, token.key, slug='a'))
+        self.backend.deactivate(user, slug='a', key=token.key)
+        assert_false(self.backend.exists_valid(user, token.key, slug='a'))
+
+    @data_consumer('create_user')
+    def test_cache_tokens_should_not_be_filtered_by_model_class(self, user):
+        with assert_raises(TypeError):
+            self.backend.filter_active_tokens(User)
+        with assert_raises(TypeError):
+            self.backend.consume(User, 'key')
+
+
+class BackendSettingTestCase(GermaniumTestCase):
+
+    def test_backend_should_be_selected_via_settings(self):
+        assert_is_instance(get_backend(), ORMTokenBackend)
+        with override_settings(VERIFICATION_TOKEN_STORAGE_BACKEND='verification_token.backends.cache.CacheTokenBackend'):
+            assert_is_instance(get_backend(), CacheTokenBackend)
@@ -1,28 +1,36 @@
 from datetime import timedelta
 from io import StringIO
 
+from django.contrib.auth.models import User
 from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import override_settings
 from django.utils import timezone
 
 from freezegun import freeze_time
-from germanium.annotations import data_provider
+from germanium.decorators import data_consumer
 from germanium.test_cases.default import GermaniumTestCase
-from germanium.tools import assert_equal
+from germanium.tools import assert_equal, assert_false, assert_in, assert_raises, assert_true
 from germanium.tools.models import assert_qs_contains, assert_qs_not_contains
-from verification_token.models import VerificationToken
+from verification_token.management.commands import fill_verification_token_key_reservoir
+from verification_token.management.commands.clean_verification_tokens import Command
+from verification_token.models import (HASHED_KEY_PREFIX, VerificationToken,
+                                       VerificationTokenGeneration, VerificationTokenReservedKey)
 
 from .base import BaseTestCaseMixin
 
 
 __all__ = (
    'CleanVerificationTokensCommandTestCase',
+   'FillVerificationTokenKeyReservoirCommandTestCase',
+   'HashVerificationTokenKeysCommandTestCase',
 )
 
 
 class CleanVerificationTokensCommandTestCase(BaseTestCaseMixin, GermaniumTestCase):
 
     @freeze_time(timezone.now())
-    @data_provider('create_user')
+    @data_consumer('create_user')
     def test_clean_verification_tokens_removes_only_non_active_tokens(self, user):
         active_tokens_without_expirations = [VerificationToken.objects.deactivate_and_create(
             obj=user, deactivate_old_tokens=False, expiration_in_minutes=None) for _ in range(10)]
@@ -47,3 +55,217 @@ class CleanVerificationTokensCommandTestCase(BaseTestCaseMixin, GermaniumTestCas
             assert_qs_not_contains(all_tokens_qs, expired_tokens)
             assert_qs_not_contains(all_tokens_qs, deactivated_tokens)
             assert_qs_not_contains(all_tokens_qs, expired_and_deactivated_tokens)
+
+    @data_consumer('create_user')
+    def test_clean_verification_tokens_removes_unused_generation_rows(self, user):
+        other_user = User.objects.create_user('other')
+        VerificationToken.objects.get_active_or_create(user, slug='a')
+        VerificationToken.objects.get_active_or_create(user)
+        VerificationToken.objects.get_active_or_create(other_user, slug='a')
+        VerificationToken.objects.deactivate(user, slug='a')
+        VerificationToken.objects.deactivate(other_user, slug='a')
+        VerificationTokenGeneration.objects.increment(other_user, slug='a')
+
+        stdout = StringIO()
+        call_command('clean_verification_tokens', stdout=stdout)
+        assert_in('Deleted 1 unused verification token generation rows', stdout.getvalue())
+        # rows with an active token or an incremented generation are kept
+        assert_equal(
+            set(VerificationTokenGeneration.objects.values_list('object_id', 'slug', 'generation')),
+            {(str(user.pk), '', 0), (str(other_user.pk), 'a', 1)}
+        )
+
+    @data_consumer('create_user')
+    def test_clean_verification_tokens_should_delete_unused_generation_rows_in_batches(self, user):
+        users = [User.objects.create_user('user{}'.format(i)) for i in range(5)]
+        for other_user in users:
+            VerificationToken.objects.get_active_or_create(other_user, slug='a')
+        VerificationToken.objects.deactivate(users[0], slug='a')
+
+        stdout = StringIO()
+        call_command('clean_verification_tokens', batch_size=2, dry_run=True, stdout=stdout)
+        assert_in('Would delete 1 unused verification token generation rows', stdout.getvalue())
+        assert_equal(VerificationTokenGeneration.objects.count(), 5)
+
+        VerificationToken.objects.update(is_active=False)
+        stdout = StringIO()
+        call_command('clean_verification_tokens', batch_size=2, stdout=stdout)
+        output = stdout.getvalue()
+        assert_in('Batch 1: deleted 2 unused verification token generation rows', output)
+        assert_in('Batch 3: deleted 1 unused verification token generation rows', output)
+        assert_in('Deleted 5 unused verification token generation rows', output)
+        assert_equal(VerificationTokenGeneration.objects.count(), 0)
+
+    @data_consumer('create_user')
+    def test_clean_verification_tokens_daemon_should_remove_unused_generation_rows(self, user):
+        VerificationToken.objects.get_active_or_create(user, slug='a')
+
+        def wait(seconds):
+            passes.append(VerificationTokenGeneration.objects.count())
+            if len(passes) == 1:
+                VerificationToken.objects.deactivate(user, slug='a')
+            else:
+                command.request_stop()
+
+        passes = []
+        command = Command()
+        command.wait = wait
+        stdout = StringIO()
+        call_command(command, daemon=True, interval=0, stdout=stdout, stderr=StringIO())
+        assert_equal(passes, [1, 0])
+        assert_in('Deleted 1 unused verification token generation rows', stdout.getvalue())
+
+    def _create_removable_tokens(self, user, count):
+        tokens = [VerificationToken.objects.deactivate_and_create(
+            obj=user, deactivate_old_tokens=False, expiration_in_minutes=None) for _ in range(count)]
+        VerificationToken.objects.filter(pk__in=[token.pk for token in tokens]).update(is_active=False)
+        return tokens
+
+    @data_consumer('create_user')
+    def test_clean_verification_tokens_should_delete_tokens_in_batches(self, user):
+        active_token = VerificationToken.objects.deactivate_and_create(
+            obj=user, deactivate_old_tokens=False, expiration_in_minutes=None)
+        self._create_removable_tokens(user, 20)
+
+        stdout = StringIO()
+        call_command('clean_verification_tokens', batch_size=7, stdout=stdout, stderr=StringIO())
+        assert_equal(list(VerificationToken.objects.all()), [active_token])
+        output = stdout.getvalue()
+        assert_in('Batch 1: deleted 7 inactive verification tokens', output)
+        assert_in('Batch 3: deleted 6 inactive verification tokens', output)
+        assert_in('Deleted 20 inactive or expired verification tokens', output)
+
+    @data_consumer('create_user')
+    @override_settings(VERIFICATION_TOKEN_GENERATION_REVOCATION=True)
+    def test_clean_verification_tokens_should_remove_revoked_tokens(self, user):
+        revoked_tokens = [VerificationToken.objects.deactivate_and_create(
+            obj=user, deactivate_old_tokens=False, expiration_in_minutes=None) for _ in range(5)]
+        VerificationToken.objects.deactivate(user)
+        active_token = VerificationToken.objects.deactivate_and_create(obj=user, expiration_in_minutes=None)
+
+        call_command('clean_verification_tokens', stdout=StringIO(), stderr=StringIO())
+        all_tokens_qs = VerificationToken.objects.all()
+        assert_qs_contains(all_tokens_qs, [active_token])
+        assert_qs_not_contains(all_tokens_qs, revoked_tokens)
+
+    @data_consumer('create_user')
+    def test_clean_verification_tokens_dry_run_should_not_delete_tokens(self, user):
+        self._create_removable_tokens(user, 10)
+
+        stdout = StringIO()
+        call_command('clean_verification_tokens', batch_size=3, dry_run=True, stdout=stdout, stderr=StringIO())
+        assert_equal(VerificationToken.objects.count(), 10)
+        assert_in('Would delete 10 inactive or expired verification tokens', stdout.getvalue())
+
+    @data_consumer('create_user')
+    def test_clean_verification_tokens_should_be_resumable(self, user):
+        tokens = self._create_removable_tokens(user, 10)
+
+        stdout = StringIO()
+        call_command('clean_verification_tokens', max_runtime=0, stdout=stdout, stderr=StringIO())
+        assert_equal(VerificationToken.objects.count(), 10)
+        assert_in('Max runtime reached', stdout.getvalue())
+
+        call_command('clean_verification_tokens', from_pk=tokens[4].pk, stdout=StringIO(), stderr=StringIO())
+        assert_equal(set(VerificationToken.objects.all()), set(tokens[:5]))
+
+    @data_consumer('create_user')
+    def test_clean_verification_tokens_daemon_should_process_only_new_and_expired_tokens(self, user):
+        with freeze_time(timezone.now()) as frozen_time:
+            self._create_removable_tokens(user, 3)
+            deactivated_token = VerificationToken.objects.deactivate_and_create(
+                obj=user, deactivate_old_tokens=False, expiration_in_minutes=None)
+            expiring_token = VerificationToken.objects.deactivate_and_create(
+                obj=user, deactivate_old_tokens=False, expiration_in_minutes=1)
+            active_token = VerificationToken.objects.deactivate_and_create(
+                obj=user, deactivate_old_tokens=False, expiration_in_minutes=None)
+            passes = []
+
+            def wait(seconds):
+                passes.append(set(VerificationToken.objects.all()))
+                if len(passes) == 1:
+                    self._create_removable_tokens(user, 2)
+                    VerificationToken.objects.filter(pk=deactivated_token.pk).update(is_active=False)
+                    frozen_time.tick(timedelta(minutes=2))
+                elif len(passes) == 3:
+                    command.request_stop()
+
+            command = Command()
+            command.wait = wait
+            stdout = StringIO()
+            call_command(command, daemon=True, interval=0, full_sweep_every=3, stdout=stdout, stderr=StringIO())
+
+        # deactivated token is removed only by the full sweep
+        assert_equal(passes[0], {deactivated_token, expiring_token, active_token})
+        assert_equal(passes[1], {deactivated_token, active_token})
+        assert_equal(passes[2], {active_token})
+        output = stdout.getvalue()
+        assert_in('Pass 1 (full): deleted 3', output)
+        assert_in('Pass 2 (incremental): deleted 3', output)
+        assert_in('Pass 3 (full): deleted 1', output)
+        assert_in('Daemon stopped', output)
+
+
+class FillVerificationTokenKeyReservoirCommandTestCase(BaseTestCaseMixin, GermaniumTestCase):
+
+    @override_settings(VERIFICATION_TOKEN_KEY_RESERVOIR_SIZE=25)
+    def test_fill_verification_token_key_reservoir_should_reserve_unique_keys(self):
+        call_command('fill_verification_token_key_reservoir', batch_size=10, stdout=StringIO())
+        assert_equal(VerificationTokenReservedKey.objects.count(), 25)
+        call_command('fill_verification_token_key_reservoir', size=30, stdout=StringIO())
+        assert_equal(VerificationTokenReservedKey.objects.values('key').distinct().count(), 30)
+
+    def test_fill_verification_token_key_reservoir_daemon_should_refill_reservoir_under_low_watermark(self):
+        depths = []
+
+        def wait(seconds):
+            depths.append(VerificationTokenReservedKey.objects.count())
+            if len(depths) == 1:
+                VerificationTokenReservedKey.objects.filter(
+                    pk__in=VerificationTokenReservedKey.objects.values('pk')[:5]
+                ).delete()
+            elif len(depths) == 2:
+                VerificationTokenReservedKey.objects.filter(
+                    pk__in=VerificationTokenReservedKey.objects.values('pk')[:10]
+                ).delete()
+            else:
+                command.request_stop()
+
+        command = fill_verification_token_key_reservoir.Command()
+        command.wait = wait
+        stdout = StringIO()
+        call_command(command, daemon=True, size=20, low_watermark=10, interval=0, stdout=stdout)
+        assert_equal(depths, [20, 15, 20])
+        assert_in('Daemon stopped', stdout.getvalue())
+
+
+class HashVerificationTokenKeysCommandTestCase(BaseTestCaseMixin, GermaniumTestCase):
+
+    @data_consumer('create_user')
+    def test_hash_verification_token_keys_should_keep_tokens_valid(self, user):
+        tokens = [
+            VerificationToken.objects.deactivate_and_create(user, slug='a', deactivate_old_tokens=False)
+            for _ in range(5)
+        ]
+        short_token = VerificationToken.objects.deactivate_and_create(user, key_generator_kwargs={'length': 6})
+        with override_settings(VERIFICATION_TOKEN_SLUG_PROFILES={'sms': {'KEY_LENGTH': 6, 'SCOPED_KEYS': True}}):
+            scoped_token = VerificationToken.objects.deactivate_and_create(user, slug='sms')
+
+        stdout = StringIO()
+        with override_settings(VERIFICATION_TOKEN_HASHED_KEYS=True):
+            call_command('hash_verification_token_keys', batch_size=2, stdout=stdout)
+            assert_in('Hashed keys of 7 verification tokens', stdout.getvalue())
+            assert_false(VerificationToken.objects.filter(selector__isnull=False).exists())
+            assert_false(VerificationToken.objects.exclude(key__startswith=HASHED_KEY_PREFIX).exists())
+            assert_false(VerificationToken.objects.filter(key=tokens[0].key).exists())
+
+            for token in tokens:
+                assert_true(VerificationToken.objects.exists_valid(user, token.key, slug='a'))
+                assert_equal(VerificationToken.objects.verify_key(token.key, slug='a'), token)
+                assert_false(VerificationToken.objects.exists_valid(user, token.key[:-1], slug='a'))
+            assert_true(VerificationToken.objects.exists_valid(user, short_token.key))
+            assert_true(VerificationToken.objects.exists_valid(user, scoped_token.key, slug='sms'))
+
+    def test_hash_verification_token_keys_should_require_hashed_keys_setting(self):
+        with assert_raises(CommandError):
+            call_command('hash_verification_token_keys', stdout=StringIO())
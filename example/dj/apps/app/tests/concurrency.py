@@ -0,0 +1,59 @@
+import threading
+
+from django.contrib.auth.models import User
+from django.db import OperationalError, connection
+from django.test import TransactionTestCase
+
+from germanium.tools import assert_equal
+from verification_token.models import VerificationToken
+
+from .base import BaseTestCaseMixin
+
+
+__all__ = (
+    'ConcurrentTokenTestCase',
+)
+
+
+class ConcurrentTokenTestCase(BaseTestCaseMixin, TransactionTestCase):
+
+    def _call_concurrently(self, func, threads_count=8, calls_per_thread=5):
+        barrier = threading.Barrier(threads_count)
+        results = []
+        errors = []
+
+        def worker():
+            try:
+                barrier.wait()
+                for _ in range(calls_per_thread):
+                    while True:
+                        try:
+                            results.append(func())
+                            break
+                        except OperationalError:
+                            # shared cache in-memory SQLite database reports locked table immediately instead of
+                            # waiting for the lock
+                            if connection.vendor != 'sqlite':
+                                raise
+            except Exception as ex:
+                errors.append(ex)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_equal(errors, [])
+        return results
+
+    def test_concurrent_get_active_or_create_should_return_the_same_token(self):
+        users = [self.create_user()] + [User.objects.create_user('user{}'.format(i)) for i in range(2)]
+
+        results = self._call_concurrently(
+            lambda: [VerificationToken.objects.get_active_or_create(user, slug='resend').key for user in users]
+        )
+        for i, user in enumerate(users):
+            assert_equal(VerificationToken.objects.filter_active_tokens(user, slug='resend').count(), 1)
+            assert_equal({keys[i] for keys in results}, {VerificationToken.objects.get(object_id=user.pk).key})
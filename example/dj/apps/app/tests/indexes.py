@@ -0,0 +1,86 @@
+import os
+from unittest import skipUnless
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.utils import timezone
+
+from germanium.decorators import data_consumer
+from germanium.test_cases.default import GermaniumTestCase
+from germanium.tools import assert_in
+from verification_token.management.commands.clean_verification_tokens import Command
+from verification_token.models import VerificationToken
+
+from .base import BaseTestCaseMixin
+
+
+__all__ = (
+    'VerificationTokenIndexesTestCase',
+)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'Query plans are checked only in SQLite')
+class VerificationTokenIndexesTestCase(BaseTestCaseMixin, GermaniumTestCase):
+
+    # query plans are checked on a small table by default, the production sized table (e.g. 1000000 tokens) can be
+    # seeded with the environment variable VERIFICATION_TOKEN_INDEXES_SEED_SIZE
+    SEED_SIZE = int(os.environ.get('VERIFICATION_TOKEN_INDEXES_SEED_SIZE', 10000))
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        # raw insert, creating model instances would be too slow
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                WITH RECURSIVE seq(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM seq WHERE x < %s)
+                INSERT INTO verification_token_verificationtoken
+                    (created_at, content_type_id, object_id, key, expires_at, slug, is_active, is_key_scoped,
+                     generation)
+                SELECT
+                    datetime('now', '-' || (x %% 10000) || ' minutes'),
+                    %s,
+                    'seed' || (x %% 100000),
+                    'SEED' || x,
+                    CASE WHEN x %% 3 = 0 THEN NULL ELSE datetime('now', '+' || (x %% 1000 - 500) || ' minutes') END,
+                    CASE WHEN x %% 2 = 0 THEN 'slug' ELSE NULL END,
+                    x %% 4 != 0,
+                    0,
+                    0
+                FROM seq
+                """,
+                [cls.SEED_SIZE, ContentType.objects.get_for_model(User).pk]
+            )
+            cursor.execute('ANALYZE')
+
+    @data_consumer('create_user')
+    def test_filter_active_tokens_should_use_composite_index(self, user):
+        qs = VerificationToken.objects.filter_active_tokens(user, slug='slug').order_by('created_at')
+        assert_in('vt_active_tokens_idx', qs.explain())
+
+    def test_expired_tokens_cleanup_should_use_expires_at_index(self):
+        qs = VerificationToken.objects.filter(expires_at__isnull=False, expires_at__lt=timezone.now()).order_by()
+        assert_in('vt_expires_at_idx', qs.values('pk').explain())
+
+    def test_inactive_tokens_cleanup_should_use_inactive_index(self):
+        qs = VerificationToken.objects.filter(is_active=False).order_by()
+        assert_in('vt_inactive_idx', qs.values('pk').explain())
+
+    def test_cleanup_batches_should_use_partial_indexes(self):
+        # removable tokens are only a small part of the regularly cleaned table
+        now = timezone.now()
+        VerificationToken.objects.filter(is_active=False, pk__gt=100).update(is_active=True)
+        VerificationToken.objects.filter(expires_at__lt=now, pk__gt=100).update(expires_at=None)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        removable_token_passes = dict(Command().get_removable_token_passes(now))
+        for label, index_name in (('inactive verification tokens', 'vt_inactive_idx'),
+                                  ('expired verification tokens', 'vt_expires_at_idx')):
+            qs = removable_token_passes[label].filter(pk__gt=10).order_by('pk').values('pk')[:1000]
+            assert_in(index_name, qs.explain())
+
+    def test_key_lookup_should_use_key_index(self):
+        qs = VerificationToken.objects.filter(VerificationToken.get_key_lookup('SEED7')).order_by()
+        assert_in('vt_key_idx', qs.values('pk').explain())
@@ -0,0 +1,120 @@
+from datetime import timedelta
+from io import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db.utils import IntegrityError
+from django.test import override_settings
+from django.utils import timezone
+
+from freezegun import freeze_time
+from germanium.decorators import data_consumer
+from germanium.test_cases.default import GermaniumTestCase
+from germanium.tools import assert_equal, assert_raises, assert_true
+from verification_token.metrics import BaseMetricsSink
+from verification_token.models import VerificationToken
+from verification_token.signals import token_deactivated, token_issued, token_verified
+
+from .base import BaseTestCaseMixin
+from .models import generator_with_counter, Counter
+
+
+__all__ = (
+    'MetricsTestCase',
+)
+
+
+class TestMetricsSink(BaseMetricsSink):
+
+    counters = []
+    timings = []
+
+    def incr(self, name, value=1, tags=None):
+        self.counters.append((name, value, tags))
+
+    def timing(self, name, milliseconds, tags=None):
+        self.timings.append((name, tags))
+
+    def gauge(self, name, value, tags=None):
+        pass
+
+
+@override_settings(VERIFICATION_TOKEN_METRICS_SINK='app.tests.metrics.TestMetricsSink')
+class MetricsTestCase(BaseTestCaseMixin, GermaniumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        TestMetricsSink.counters.clear()
+        TestMetricsSink.timings.clear()
+
+    @data_consumer('create_user')
+    def test_token_operations_should_emit_metrics(self, user):
+        token = VerificationToken.objects.deactivate_and_create(user, slug='a', expiration_in_minutes=10)
+        VerificationToken.objects.exists_valid(user, token.key, slug='a')
+        VerificationToken.objects.exists_valid(user, 'invalid', slug='a')
+        with freeze_time(timezone.now() + timedelta(minutes=11)):
+            VerificationToken.objects.exists_valid(user, token.key, slug='a')
+        VerificationToken.objects.deactivate(user, slug='a')
+
+        assert_equal(TestMetricsSink.counters, [
+            ('verification_token.deactivated', 0, {'slug': 'a'}),
+            ('verification_token.issued', 1, {'slug': 'a'}),
+            ('verification_token.verified', 1, {'slug': 'a', 'result': 'hit'}),
+            ('verification_token.verified', 1, {'slug': 'a', 'result': 'miss'}),
+            ('verification_token.verified', 1, {'slug': 'a', 'result': 'expired'}),
+            ('verification_token.deactivated', 1, {'slug': 'a'}),
+        ])
+        assert_equal(TestMetricsSink.timings, [('verification_token.verify', {'slug': 'a'})] * 3)
+
+    @data_consumer('create_user')
+    def test_key_collisions_and_cleanup_should_emit_metrics(self, user):
+        key_generator_kwargs = {'generator': generator_with_counter, 'counter': Counter()}
+        VerificationToken.objects.deactivate_and_create(user, key_generator_kwargs=key_generator_kwargs)
+        with override_settings(VERIFICATION_TOKEN_MAX_RANDOM_KEY_ITERATIONS=3):
+            with assert_raises(IntegrityError):
+                VerificationToken.objects.deactivate_and_create(user, key_generator_kwargs=key_generator_kwargs)
+        call_command('clean_verification_tokens', stdout=StringIO())
+
+        assert_equal([counter for counter in TestMetricsSink.counters if counter[0].endswith('key_collisions')],
+                     [('verification_token.key_collisions', 1, {
+                         'slug': None, 'generator': 'generator_with_counter'
+                     })] * 3)
+        assert_true(('verification_token.cleaned', 1, {}) in TestMetricsSink.counters)
+
+    @data_consumer('create_user')
+    @override_settings(VERIFICATION_TOKEN_VALIDITY_CACHE=True)
+    def test_validity_cache_should_emit_hit_and_miss_metrics(self, user):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            token = VerificationToken.objects.deactivate_and_create(user, slug='a')
+        VerificationToken.objects.exists_valid(user, token.key, slug='a')
+        VerificationToken.objects.exists_valid(user, 'invalid', slug='a')
+        VerificationToken.objects.exists_valid(user, 'invalid', slug='a')
+
+        assert_equal([counter for counter in TestMetricsSink.counters if 'validity_cache' in counter[0]], [
+            ('verification_token.validity_cache.hit', 1, {'slug': 'a'}),
+            ('verification_token.validity_cache.miss', 1, {'slug': 'a'}),
+            ('verification_token.validity_cache.hit', 1, {'slug': 'a'}),
+        ])
+
+    @data_consumer('create_user')
+    def test_token_operations_should_send_signals(self, user):
+        received = []
+
+        def receiver(signal, **kwargs):
+            received.append((signal, kwargs))
+
+        for signal in (token_issued, token_verified, token_deactivated):
+            signal.connect(receiver, sender=VerificationToken)
+        try:
+            token = VerificationToken.objects.deactivate_and_create(user, deactivate_old_tokens=False)
+            VerificationToken.objects.consume(user, token.key)
+        finally:
+            for signal in (token_issued, token_verified, token_deactivated):
+                signal.disconnect(receiver, sender=VerificationToken)
+
+        assert_equal(received, [
+            (token_issued, {'sender': VerificationToken, 'tokens': [token]}),
+            (token_verified, {'sender': VerificationToken, 'obj': user, 'slug': None, 'key': token.key,
+                              'result': 'hit'}),
+        ])
@@ -1,16 +1,28 @@
+import string
 from datetime import timedelta
+from unittest import skipUnless
+from unittest.mock import patch
 
 from django.contrib.auth.models import Group, User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
 from django.db.utils import IntegrityError
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from freezegun import freeze_time
-from germanium.annotations import data_provider
+from germanium.decorators import data_consumer
 from germanium.test_cases.default import GermaniumTestCase
-from germanium.tools import (assert_equal, assert_false, assert_raises,
-                             assert_true, assert_is_none)
-from verification_token.models import VerificationToken
+from germanium.tools import (assert_equal, assert_false, assert_not_equal, assert_raises,
+                             assert_true, assert_is_none, assert_is_not_none)
+from verification_token import keyspace, validity_cache
+from verification_token.config import settings
+from verification_token.generators import batch_random_string_generator
+from verification_token.models import SELECTOR_LENGTH, VerificationToken, VerificationTokenReservedKey, get_key_digest
+from verification_token.signals import keyspace_exhausting
 
 from .base import BaseTestCaseMixin
 
@@ -45,7 +57,7 @@ def assert_token_is_same_active_and_valid(original_token, token_to_compare):
 
 class TokenTestCase(BaseTestCaseMixin, GermaniumTestCase):
 
-    @data_provider('create_user')
+    @data_consumer('create_user')
     def test_verification_token_should_be_created_and_old_one_should_be_deactivated(self, user):
         token1 = VerificationToken.objects.deactivate_and_create(user)
         assert_true(token1.is_valid)
@@ -57,7 +69,7 @@ class TokenTestCase(BaseTestCaseMixin, GermaniumTestCase):
         assert_false(token1.is_valid)
         assert_false(token1.is_active)
 
-    @data_provider('create_user')
+    @data_consumer('create_user')
     def test_verification_token_with_different_slug_should_not_be_deactivated(self, user):
         token1 = VerificationToken.objects.deactivate_and_create(user, slug='a')
         assert_true(token1.is_valid)
@@ -69,21 +81,21 @@ class TokenTestCase(BaseTestCaseMixin, GermaniumTestCase):
         assert_true(token1.is_valid)
         assert_true(token1.is_active)
 
-    @data_provider('create_user')
+    @data_consumer('create_user')
     def test_valid_verification_token_with_same_slug_should_exists(self, user):
         token = VerificationToken.objects.deactivate_and_create(user, slug='a')
         assert_true(VerificationToken.objects.exists_valid(user, slug='a', key=token.key))
         assert_false(VerificationToken.objects.exists_valid(user, slug='b', key=token.key))
         assert_false(VerificationToken.objects.exists_valid(user, slug='a', key='invalid key'))
 
-    @data_provider('create_user')
+    @data_consumer('create_user')
     def test_verification_token_should_be_invalid_after_expiration(self, user):
         token = VerificationToken.objects.deactivate_and_create(user, expiration_in_minutes=10)
         with freeze_time(timezone.now() + timedelta(minutes=10), tick=True):
             assert_false(token.is_valid)
             assert_true(token.is_active)
 
-    @data_provider('create_user')
+    @data_consumer('create_user')
     @override_settings(VERIFICATION_TOKEN_DEFAULT_EXPIRATION=10)
     def test_verification_token_expiration_should_be_set_via_settings(self, user):
         token = VerificationToken.objects.deactivate_and_create(user)
@@ -91,7 +103,7 @@ class TokenTestCase(BaseTestCaseMixin, GermaniumTestCase):
             assert_false(token.is_valid)
             assert_true(token.is_active)
 
-    @data_provider('create_user')
+    @data_consumer('create_user')
     def test_key_generator_values_should_be_able_to_change(self, user):
         token = VerificationToken.objects.deactivate_and_create(
             user, key_generator_kwargs={'length': 100, 'allowed_chars': 'abc'
@@ -99,27 +111,27 @@ class TokenTestCase(BaseTestCaseMixin, GermaniumTestCase):
         assert_equal(len(token.key), 100)
         assert_false(set(token.key) - set('abc'))
 
-    @data_provider('create_user')
+    @data_consumer('create_user')
     @override_settings(VERIFICATION_TOKEN_DEFAULT_KEY_LENGTH=100, VERIFICATION_TOKEN_DEFAULT_KEY_CHARS='abc')
     def test_key_generator_values_should_be_able_to_change_via_settings(self, user):
         token = VerificationToken.objects.deactivate_and_create(user)
         assert_equal(len(token.key), 100)
         assert_false(set(token.key) - set('abc'))
 
-    @data_provider('create_user')
+    @data_consumer('create_user')
     def test_key_generator_should_be_able_to_change(self, user):
         token = VerificationToken.objects.deactivate_and_create(user, key_generator_kwargs={
             'generator': test_generator
         })
         assert_equal(token.key, 'test')
 
-    @data_provider('create_user')
+    @data_consumer('create_user')
     @override_settings(VERIFICATION_TOKEN_DEFAULT_KEY_GENERATOR=test_generator)
     def test_key_generator_should_be_able_to_change_via_settings(self, user):
         token = VerificationToken.objects.deactivate_and_create(user)
         assert_equal(token.key, 'test')
 
-    @data_provider('create_user')
+    @data_consumer('create_user')
     @override_settings(VERIFICATION_TOKEN_MAX_RANDOM_KEY_ITERATIONS=12)
     def test_key_generator_iterations_should_be_according_to_settings(self, user):
         counter = Counter()
@@ -136,7 +148,7 @@ class TokenTestCase(BaseTestCaseMixin, GermaniumTestCase):
             })
         assert_equal(counter.iterations, 12)
 
-    @data_provider('create_user')
+    @data_consumer('create_user')
     def test_verification_token_should_store_extra_data(self, user):
         EXTRA_DATA_1 = {'a': 123}
         EXTRA_DATA_2 = {'b': 456}
@@ -154,19 +166,19 @@ class TokenTestCase(BaseTestCaseMixin, GermaniumTestCase):
         token.save()
         assert_is_none(token.get_extra_data())
 
-    @data_provider('create_user')
+    @data_consumer('create_user')
     def test_verification_token_expiration_should_be_nullable(self, user):
         token = VerificationToken.objects.deactivate_and_create(user, expiration_in_minutes=None)
         assert_is_none(token.expires_at)
 
-    @data_provider('create_user')
+    @data_consumer('create_user')
     def test_verification_token_does_not_expire_without_expiration_value(self, user):
         token = VerificationToken.objects.deactivate_and_create(user, expiration_in_minutes=None)
         with freeze_time(timezone.now() + timedelta(days=30*365), tick=True):
             assert_true(token.is_valid)
             assert_true(token.is_active)
 
-    @data_provider('create_user')
+    @data_consumer('create_user')
     def test_verification_token_get_active_or_create_should_return_existing_active_and_valid_token(self, user):
         created_token = VerificationToken.objects.deactivate_and_create(user, expiration_in_minutes=10)
 
@@ -178,7 +190,7 @@ class TokenTestCase(BaseTestCaseMixin, GermaniumTestCase):
             obtained_token = VerificationToken.objects.get_active_or_create(user)
             assert_token_is_same_active_and_valid(created_token, obtained_token)
 
-    @data_provider('create_user')
+    @data_consumer('create_user')
     def test_verification_token_should_be_found_by_model_class_or_instance(self, user):
         # 2 users of the same content type with tokens created
         user2 = User.objects._create_user('user2', 'user2@test.cz', 'test2')
@@ -199,3 +211,641 @@ class TokenTestCase(BaseTestCaseMixin, GermaniumTestCase):
         tokens_by_object = VerificationToken.objects.filter_active_tokens(Group)
         assert_equal(tokens_by_object.count(), 1)
         assert_token_is_same_active_and_valid(tokens_by_object.first(), token_from_group)
+
+    @data_consumer('create_user')
+    def test_verification_tokens_should_be_created_in_bulk_and_old_ones_should_be_deactivated(self, user):
+        users = [user] + [
+            User.objects._create_user('user{}'.format(i), 'user{}@test.cz'.format(i), 'test') for i in range(9)
+        ]
+        old_tokens = [VerificationToken.objects.deactivate_and_create(obj) for obj in users]
+
+        tokens = VerificationToken.objects.bulk_deactivate_and_create(
+            User.objects.all(), slug=None, extra_data={'a': 1}, batch_size=3
+        )
+        assert_equal(len(tokens), 10)
+        assert_equal(len({token.key for token in tokens}), 10)
+        assert_equal({token.object_id for token in tokens}, {str(obj.pk) for obj in users})
+        for token in VerificationToken.objects.filter(pk__in=[token.pk for token in old_tokens]):
+            assert_false(token.is_active)
+        for obj in users:
+            token = VerificationToken.objects.filter_active_tokens(obj).get()
+            assert_true(token.is_valid)
+            assert_equal(token.get_extra_data(), {'a': 1})
+
+    @data_consumer('create_user')
+    def test_verification_tokens_bulk_create_should_use_constant_number_of_queries_per_batch(self, user):
+        users = [User.objects._create_user('user{}'.format(i), 'user{}@test.cz'.format(i), 'test') for i in range(9)]
+        ContentType.objects.get_for_model(User)
+        with CaptureQueriesContext(connection) as context:
+            VerificationToken.objects.bulk_deactivate_and_create(users, batch_size=100)
+        # update of old tokens, key uniqueness check and insert (in the batch savepoint)
+        assert_equal(len([query for query in context.captured_queries if 'SAVEPOINT' not in query['sql']]), 3)
+
+    @data_consumer('create_user')
+    def test_verification_tokens_bulk_create_should_process_every_batch_in_transaction(self, user):
+        users = [user] + [User.objects.create_user('user{}'.format(i)) for i in range(5)]
+        assert_equal(VerificationToken.objects.bulk_deactivate_and_create(users, batch_size=4, return_tokens=False), 6)
+
+        generated_keys = []
+
+        def failing_generator(**kwargs):
+            if len(generated_keys) >= 3:
+                raise ValueError('Key generator failed')
+            generated_keys.append('failing{}'.format(len(generated_keys)))
+            return generated_keys[-1]
+
+        old_tokens = [VerificationToken.objects.filter_active_tokens(obj).get() for obj in users]
+        with assert_raises(ValueError):
+            VerificationToken.objects.bulk_deactivate_and_create(
+                users, batch_size=3, key_generator_kwargs={'generator': failing_generator}
+            )
+        # the first batch is created, old tokens of the failed batch stay active
+        for obj in users[:3]:
+            assert_true(VerificationToken.objects.filter_active_tokens(obj).get().key.startswith('failing'))
+        for obj, old_token in zip(users[3:], old_tokens[3:]):
+            assert_equal(VerificationToken.objects.filter_active_tokens(obj).get(), old_token)
+
+    @override_settings(VERIFICATION_TOKEN_MAX_RANDOM_KEY_ITERATIONS=12)
+    def test_bulk_key_generator_should_regenerate_only_colliding_keys(self):
+        counter = Counter()
+        assert_equal(VerificationToken.generate_keys(1, generator=generator_with_counter, counter=counter),
+                     {'not_unique'})
+        assert_equal(counter.iterations, 1)
+
+        counter = Counter()
+        with assert_raises(IntegrityError):
+            VerificationToken.generate_keys(2, generator=generator_with_counter, counter=counter)
+
+    @data_consumer('create_user')
+    @override_settings(VERIFICATION_TOKEN_OPTIMISTIC_KEY_GENERATION=True, VERIFICATION_TOKEN_MAX_RANDOM_KEY_ITERATIONS=12)
+    def test_optimistic_key_generator_iterations_should_be_according_to_settings(self, user):
+        counter = Counter()
+        token = VerificationToken.objects.deactivate_and_create(user, key_generator_kwargs={
+            'generator': generator_with_counter, 'counter': counter
+        })
+        assert_equal(token.key, 'not_unique')
+        assert_equal(counter.iterations, 1)
+
+        counter = Counter()
+        with assert_raises(IntegrityError):
+            VerificationToken.objects.deactivate_and_create(user, key_generator_kwargs={
+                'generator': generator_with_counter, 'counter': counter
+            })
+        assert_equal(counter.iterations, 12)
+        assert_equal(VerificationToken.objects.filter_active_tokens(user).count(), 0)
+
+    @data_consumer('create_user')
+    @override_settings(VERIFICATION_TOKEN_OPTIMISTIC_KEY_GENERATION=True)
+    def test_optimistic_key_generation_should_issue_token_with_single_insert(self, user):
+        ContentType.objects.get_for_model(User)
+        with CaptureQueriesContext(connection) as context:
+            token = VerificationToken.objects.deactivate_and_create(user, deactivate_old_tokens=False)
+        queries = [query['sql'] for query in context.captured_queries if 'SAVEPOINT' not in query['sql']]
+        assert_equal(len(queries), 1)
+        assert_true(queries[0].startswith('INSERT'))
+        assert_true(token.is_valid)
+
+        token = VerificationToken(content_type=token.content_type, object_id=token.object_id)
+        token.save()
+        assert_true(token.key)
+
+    @data_consumer('create_user')
+    def test_valid_verification_tokens_should_be_filtered_in_database(self, user):
+        token = VerificationToken.objects.deactivate_and_create(user, expiration_in_minutes=10)
+        token_without_expiration = VerificationToken.objects.deactivate_and_create(
+            user, deactivate_old_tokens=False, expiration_in_minutes=None
+        )
+        deactivated_token = VerificationToken.objects.deactivate_and_create(user, deactivate_old_tokens=False)
+        deactivated_token.is_active = False
+        deactivated_token.save()
+
+        assert_equal(set(VerificationToken.objects.valid()), {token, token_without_expiration})
+        with freeze_time(timezone.now() + timedelta(minutes=11)):
+            assert_equal(set(VerificationToken.objects.valid()), {token_without_expiration})
+            assert_false(VerificationToken.objects.exists_valid(user, key=token.key))
+            assert_true(VerificationToken.objects.exists_valid(user, key=token_without_expiration.key))
+        assert_false(VerificationToken.objects.exists_valid(user, key=deactivated_token.key))
+
+    @data_consumer('create_user')
+    def test_exists_valid_should_use_one_query(self, user):
+        token = VerificationToken.objects.deactivate_and_create(user)
+        with self.assertNumQueries(1):
+            assert_true(VerificationToken.objects.exists_valid(user, key=token.key))
+
+    @data_consumer('create_user')
+    def test_verification_token_should_be_consumed_only_once(self, user):
+        token = VerificationToken.objects.deactivate_and_create(user, slug='a', expiration_in_minutes=10)
+        assert_false(VerificationToken.objects.consume(user, token.key, slug='b'))
+        assert_false(VerificationToken.objects.consume(user, 'invalid key', slug='a'))
+        with self.assertNumQueries(1):
+            assert_true(VerificationToken.objects.consume(user, token.key, slug='a'))
+        assert_false(VerificationToken.objects.consume(user, token.key, slug='a'))
+        token.refresh_from_db()
+        assert_false(token.is_active)
+
+        expired_token = VerificationToken.objects.deactivate_and_create(user, slug='a', expiration_in_minutes=10)
+        with freeze_time(timezone.now() + timedelta(minutes=11)):
+            assert_false(VerificationToken.objects.consume(user, expired_token.key, slug='a'))
+
+    @data_consumer('create_user')
+    def test_verification_token_consume_should_return_extra_data(self, user):
+        token = VerificationToken.objects.deactivate_and_create(user, extra_data={'a': 1})
+        with self.assertNumQueries(1 if VerificationToken.objects.all()._supports_update_returning() else 2):
+            assert_equal(VerificationToken.objects.consume(user, token.key, return_extra_data=True), (True, {'a': 1}))
+        assert_equal(VerificationToken.objects.consume(user, token.key, return_extra_data=True), (False, None))
+
+    @data_consumer('create_user')
+    @override_settings(VERIFICATION_TOKEN_SLUG_PROFILES={
+        'sms': {'EXPIRATION': 5, 'KEY_LENGTH': 6, 'KEY_CHARS': '0123456789'},
+        'test': {'EXPIRATION': None, 'KEY_GENERATOR': 'app.tests.models.test_generator'},
+    })
+    @freeze_time('2026-01-01 12:00:00')
+    def test_verification_token_should_be_created_according_to_slug_profile(self, user):
+        sms_token = VerificationToken.objects.deactivate_and_create(user, slug='sms')
+        assert_equal(len(sms_token.key), 6)
+        assert_true(sms_token.key.isdigit())
+        assert_equal(sms_token.expires_at - sms_token.created_at, timedelta(minutes=5))
+
+        assert_equal(len(VerificationToken.objects.deactivate_and_create(
+            user, slug='sms', key_generator_kwargs={'length': 8}
+        ).key), 8)
+
+        test_token = VerificationToken.objects.deactivate_and_create(user, slug='test')
+        assert_equal(test_token.key, 'test')
+        assert_is_none(test_token.expires_at)
+
+        default_token = VerificationToken.objects.deactivate_and_create(user)
+        assert_equal(len(default_token.key), 20)
+        assert_equal(default_token.expires_at - default_token.created_at, timedelta(minutes=24 * 60))
+
+    def test_invalid_settings_should_raise_improperly_configured(self):
+        invalid_settings = (
+            ('DEFAULT_KEY_LENGTH', 101),
+            ('DEFAULT_KEY_CHARS', ''),
+            ('DEFAULT_EXPIRATION', -1),
+            ('DEFAULT_KEY_GENERATOR', 'app.tests.models.invalid_generator'),
+            ('SLUG_PROFILES', {'sms': {'LENGTH': 6}}),
+            ('SLUG_PROFILES', {'sms': {'KEY_LENGTH': 0}}),
+        )
+        for name, value in invalid_settings:
+            with override_settings(**{'VERIFICATION_TOKEN_{}'.format(name): value}):
+                with assert_raises(ImproperlyConfigured):
+                    getattr(settings, name)
+        assert_equal(settings.DEFAULT_KEY_LENGTH, 20)
+
+    def test_settings_should_be_reloaded_after_change(self):
+        assert_true(callable(settings.DEFAULT_KEY_GENERATOR))
+        with override_settings(VERIFICATION_TOKEN_DEFAULT_KEY_LENGTH=10):
+            assert_equal(settings.DEFAULT_KEY_LENGTH, 10)
+            assert_equal(len(VerificationToken.generate_key()), 10)
+        assert_equal(settings.DEFAULT_KEY_LENGTH, 20)
+
+    def test_batch_random_string_generator_should_generate_keys_from_allowed_chars(self):
+        keys = batch_random_string_generator.generate_many(1000)
+        assert_equal(len(keys), 1000)
+        assert_true(all(len(key) == 20 and set(key) <= set(settings.DEFAULT_KEY_CHARS) for key in keys))
+        assert_equal(len(batch_random_string_generator(length=6, allowed_chars='0123456789')), 6)
+
+        # 256 is not divisible by 100, without rejection sampling the first 56 chars would be 1.5 times more common
+        keys = ''.join(batch_random_string_generator.generate_many(100, 1000, string.printable))
+        first_chars_count = sum(key in string.printable[:56] for key in keys)
+        assert_true(abs(first_chars_count / 56 - (len(keys) - first_chars_count) / 44) < 100)
+
+    def test_generate_keys_should_use_generate_many_of_generator(self):
+        generator = Counter()
+
+        def generate_many(count, length):
+            generator.add()
+            return batch_random_string_generator.generate_many(count, length)
+        test_generator.generate_many = generate_many
+        try:
+            keys = VerificationToken.generate_keys(50, 'app.tests.models.test_generator', length=10)
+        finally:
+            del test_generator.generate_many
+        assert_equal(len(keys), 50)
+        assert_true(all(len(key) == 10 for key in keys))
+        assert_equal(generator.iterations, 1)
+
+    @data_consumer('create_user')
+    @override_settings(VERIFICATION_TOKEN_KEY_RESERVOIR=True)
+    def test_verification_token_should_be_created_with_reserved_key(self, user):
+        VerificationTokenReservedKey.objects.create(key='RESERVED1')
+        VerificationTokenReservedKey.objects.create(key='RESERVED2')
+        assert_equal(VerificationToken.objects.deactivate_and_create(user).key, 'RESERVED1')
+        # reserved keys are generated with the default generator settings only
+        assert_equal(len(VerificationToken.objects.deactivate_and_create(
+            user, key_generator_kwargs={'length': 5}
+        ).key), 5)
+        assert_equal(VerificationToken.objects.deactivate_and_create(user).key, 'RESERVED2')
+        # empty reservoir falls back to the key generation
+        assert_equal(len(VerificationToken.objects.deactivate_and_create(user).key), 20)
+
+        # key which was used by a token in the meantime is generated again
+        VerificationTokenReservedKey.objects.create(key='RESERVED2')
+        assert_equal(len(VerificationToken.objects.deactivate_and_create(user).key), 20)
+        assert_false(VerificationTokenReservedKey.objects.exists())
+
+    @override_settings(VERIFICATION_TOKEN_KEY_RESERVOIR_CLAIM_SIZE=3)
+    def test_reserved_keys_should_be_claimed_in_batches(self):
+        VerificationTokenReservedKey.objects.bulk_create([
+            VerificationTokenReservedKey(key='RESERVED{}'.format(i)) for i in range(5)
+        ])
+        try:
+            with self.assertNumQueries(1):
+                assert_equal(VerificationTokenReservedKey.objects.pop(), 'RESERVED0')
+            assert_equal(VerificationTokenReservedKey.objects.count(), 2)
+            with self.assertNumQueries(0):
+                assert_equal(VerificationTokenReservedKey.objects.pop(), 'RESERVED1')
+                assert_equal(VerificationTokenReservedKey.objects.pop(), 'RESERVED2')
+            assert_equal(VerificationTokenReservedKey.objects.pop(), 'RESERVED3')
+            VerificationTokenReservedKey.objects.clear_claimed()
+            assert_is_none(VerificationTokenReservedKey.objects.pop())
+
+            # keys are selected for update and deleted without DELETE ... RETURNING support
+            VerificationTokenReservedKey.objects.bulk_create([
+                VerificationTokenReservedKey(key='RESERVED{}'.format(i)) for i in range(5, 9)
+            ])
+            with patch('verification_token.models._supports_returning', return_value=False):
+                assert_equal(VerificationTokenReservedKey.objects.pop(), 'RESERVED5')
+            assert_equal(VerificationTokenReservedKey.objects.count(), 1)
+        finally:
+            VerificationTokenReservedKey.objects.clear_claimed()
+
+    @data_consumer('create_user')
+    def test_active_tokens_should_be_filtered_by_extra_data(self, user):
+        token_a = VerificationToken.objects.deactivate_and_create(user, extra_data={'email': 'a@example.com', 'n': 1})
+        token_b = VerificationToken.objects.deactivate_and_create(
+            user, deactivate_old_tokens=False, extra_data={'email': 'b@example.com', 'n': 2}
+        )
+        VerificationToken.objects.deactivate_and_create(user, deactivate_old_tokens=False)
+
+        assert_equal(
+            list(VerificationToken.objects.filter_active_tokens(user, extra_data__email='a@example.com')), [token_a]
+        )
+        assert_equal(list(VerificationToken.objects.filter_active_tokens(User, extra_data__n__gt=1)), [token_b])
+        with assert_raises(TypeError):
+            VerificationToken.objects.filter_active_tokens(user, is_active=False)
+
+        token_a.refresh_from_db()
+        assert_equal(token_a.extra_data, {'email': 'a@example.com', 'n': 1})
+
+    @data_consumer('create_user')
+    def test_verify_key_should_return_valid_token_with_object(self, user):
+        token = VerificationToken.objects.deactivate_and_create(user, slug='a', expiration_in_minutes=10)
+        assert_is_none(VerificationToken.objects.verify_key(token.key, slug='b'))
+        assert_is_none(VerificationToken.objects.verify_key('invalid', slug='a'))
+        assert_is_none(VerificationToken.objects.verify_key(None, slug='a'))
+
+        verified_token = VerificationToken.objects.verify_key(token.key, slug='a')
+        assert_equal(verified_token, token)
+        assert_equal(verified_token.content_object, user)
+        with freeze_time(timezone.now() + timedelta(minutes=11)):
+            assert_is_none(VerificationToken.objects.verify_key(token.key, slug='a'))
+
+        consumed_token = VerificationToken.objects.verify_key(token.key, slug='a', consume=True)
+        assert_equal(consumed_token.content_object, user)
+        assert_false(consumed_token.is_active)
+        assert_is_none(VerificationToken.objects.verify_key(token.key, slug='a', consume=True))
+
+    @data_consumer('create_user')
+    def test_hashed_verification_token_should_store_only_selector_and_key_digest(self, user):
+        plain_token = VerificationToken.objects.deactivate_and_create(user, slug='plain')
+        with override_settings(VERIFICATION_TOKEN_HASHED_KEYS=True):
+            token = VerificationToken.objects.deactivate_and_create(user)
+            raw_key = token.raw_key
+            assert_equal(len(raw_key), SELECTOR_LENGTH + 20)
+            token = VerificationToken.objects.get(pk=token.pk)
+            assert_equal(token.selector, raw_key[:SELECTOR_LENGTH])
+            assert_equal(token.key, get_key_digest(raw_key))
+            assert_is_none(token.raw_key)
+
+            assert_true(token.check_key(raw_key))
+            assert_false(token.check_key(token.key))
+            assert_true(VerificationToken.objects.exists_valid(user, raw_key))
+            assert_false(VerificationToken.objects.exists_valid(user, token.key))
+            assert_equal(VerificationToken.objects.verify_key(raw_key), token)
+            assert_is_none(VerificationToken.objects.verify_key(raw_key[:SELECTOR_LENGTH] + 'X' * 20))
+            assert_is_none(VerificationToken.objects.verify_key(None))
+            assert_is_none(VerificationToken.objects.verify_key(''))
+            assert_false(token.check_key(None))
+            assert_false(VerificationToken.objects.exists_valid(user, None))
+            # tokens created before the keys were hashed are verified by the plain key
+            assert_true(VerificationToken.objects.exists_valid(user, plain_token.key, slug='plain'))
+            assert_true(VerificationToken.objects.consume(user, raw_key))
+
+            with override_settings(VERIFICATION_TOKEN_OPTIMISTIC_KEY_GENERATION=True):
+                token = VerificationToken.objects.deactivate_and_create(user, key_generator_kwargs={'length': 6})
+            assert_equal(len(token.raw_key), SELECTOR_LENGTH + 6)
+            assert_true(VerificationToken.objects.exists_valid(user, token.raw_key))
+
+            tokens = VerificationToken.objects.bulk_deactivate_and_create([user], slug='bulk')
+            assert_true(VerificationToken.objects.exists_valid(user, tokens[0].raw_key, slug='bulk'))
+            assert_equal(VerificationToken.objects.get_active_or_create(user, slug='bulk'), tokens[0])
+        assert_false(VerificationToken.objects.exists_valid(user, tokens[0].raw_key, slug='bulk'))
+
+    @data_consumer('create_user')
+    @override_settings(VERIFICATION_TOKEN_SLUG_PROFILES={
+        'sms': {'KEY_LENGTH': 2, 'KEY_CHARS': '0123456789', 'SCOPED_KEYS': True},
+    })
+    def test_scoped_keys_should_be_unique_only_among_active_tokens_of_object(self, user):
+        users = [User.objects.create_user('user{}'.format(i)) for i in range(100)]
+        # the whole keyspace is used by other objects
+        VerificationToken.objects.bulk_create([
+            VerificationToken(content_object=other_user, key=str(i).zfill(2), slug='sms', is_key_scoped=True)
+            for i, other_user in enumerate(users)
+        ])
+
+        with self.assertNumQueries(3):
+            token = VerificationToken.objects.deactivate_and_create(user, slug='sms')
+        assert_true(token.is_key_scoped)
+        assert_equal(len(token.key), 2)
+        assert_true(VerificationToken.objects.exists_valid(user, token.key, slug='sms'))
+        # other object whose token has a different key
+        other_user = users[1] if token.key == '00' else users[0]
+        assert_false(VerificationToken.objects.exists_valid(other_user, token.key, slug='sms'))
+        assert_true(VerificationToken.objects.consume(user, token.key, slug='sms'))
+
+        tokens = [
+            VerificationToken.objects.deactivate_and_create(user, slug='sms', deactivate_old_tokens=False)
+            for _ in range(50)
+        ]
+        assert_equal(len({token.key for token in tokens}), 50)
+        with assert_raises(IntegrityError):
+            with transaction.atomic():
+                VerificationToken.objects.create(
+                    content_object=user, key=tokens[0].key, slug='sms', is_key_scoped=True
+                )
+        with assert_raises(ValueError):
+            VerificationToken.objects.verify_key(tokens[0].key, slug='sms')
+
+        assert_equal(len(VerificationToken.objects.bulk_deactivate_and_create(users[:10], slug='sms')), 10)
+
+    @data_consumer('create_user')
+    @override_settings(
+        VERIFICATION_TOKEN_SLUG_PROFILES={'sms': {'KEY_LENGTH': 6, 'KEY_CHARS': '0123456789', 'SCOPED_KEYS': True}},
+        VERIFICATION_TOKEN_HASHED_KEYS=True,
+    )
+    def test_hashed_scoped_keys_should_match_slug_profile(self, user):
+        tokens = [
+            VerificationToken.objects.deactivate_and_create(user, slug='sms', deactivate_old_tokens=False),
+            VerificationToken.objects.bulk_deactivate_and_create([user], slug='sms', deactivate_old_tokens=False)[0],
+        ]
+        with override_settings(VERIFICATION_TOKEN_OPTIMISTIC_KEY_GENERATION=True):
+            tokens.append(
+                VerificationToken.objects.deactivate_and_create(user, slug='sms', deactivate_old_tokens=False)
+            )
+        for token in tokens:
+            raw_key = token.raw_key
+            assert_equal(len(raw_key), 6)
+            assert_true(raw_key.isdigit())
+            token = VerificationToken.objects.get(pk=token.pk)
+            assert_is_none(token.selector)
+            assert_not_equal(token.key, raw_key)
+            assert_true(token.check_key(raw_key))
+            assert_false(token.check_key(token.key))
+            assert_true(VerificationToken.objects.exists_valid(user, raw_key, slug='sms'))
+            assert_false(VerificationToken.objects.exists_valid(user, token.key, slug='sms'))
+
+        assert_true(VerificationToken.objects.consume(user, tokens[0].raw_key, slug='sms'))
+        assert_false(VerificationToken.objects.exists_valid(user, tokens[0].raw_key, slug='sms'))
+        with override_settings(VERIFICATION_TOKEN_HASHED_KEYS=False):
+            assert_false(VerificationToken.objects.exists_valid(user, tokens[1].key, slug='sms'))
+
+    @data_consumer('create_user')
+    @override_settings(VERIFICATION_TOKEN_SLUG_PROFILES={'sms': {'SCOPED_KEYS': True}})
+    def test_key_should_stay_unique_without_partial_indexes_support(self, user):
+        constraint = next(
+            constraint for constraint in VerificationToken._meta.constraints if constraint.name == 'vt_key_unique'
+        )
+        with patch.object(connection.features, 'supports_partial_indexes', False):
+            assert_is_none(constraint._get_condition_sql(VerificationToken, connection.schema_editor()))
+            with assert_raises(ImproperlyConfigured):
+                VerificationToken.objects.deactivate_and_create(user, slug='sms')
+            assert_false(VerificationToken.objects.deactivate_and_create(user).is_key_scoped)
+        assert_is_not_none(constraint._get_condition_sql(VerificationToken, connection.schema_editor()))
+
+    @data_consumer('create_user')
+    @override_settings(
+        VERIFICATION_TOKEN_SLUG_PROFILES={'sms': {'KEY_LENGTH': 2, 'KEY_CHARS': '0123456789'}},
+        VERIFICATION_TOKEN_KEYSPACE_RETRIES_THRESHOLD=0.5,
+    )
+    def test_exhausting_keyspace_should_be_reported_and_key_length_adapted(self, user):
+        received = []
+
+        def receiver(**kwargs):
+            received.append(kwargs)
+
+        # half of the keyspace is used, one retry of the key generator is expected
+        VerificationToken.objects.bulk_create([
+            VerificationToken(content_object=user, key=str(i).zfill(2), slug='sms', is_active=False)
+            for i in range(50)
+        ])
+        keyspace.reset()
+        keyspace_exhausting.connect(receiver)
+        try:
+            with self.assertLogs('verification_token', 'WARNING'):
+                token = VerificationToken.objects.deactivate_and_create(user, slug='sms')
+            assert_equal(len(token.key), 2)
+            # the keyspace is checked once per interval
+            VerificationToken.objects.deactivate_and_create(user, slug='sms')
+            assert_equal(len(received), 1)
+            assert_equal(received[0]['slug'], 'sms')
+            assert_equal(received[0]['live_token_count'], 50)
+            assert_equal(received[0]['keyspace_size'], 100)
+            assert_equal(received[0]['expected_retries'], 1)
+            assert_is_none(received[0]['adapted_length'])
+
+            keyspace.reset()
+            with override_settings(VERIFICATION_TOKEN_KEYSPACE_ADAPTIVE_LENGTH=True):
+                with self.assertLogs('verification_token', 'WARNING'):
+                    token = VerificationToken.objects.deactivate_and_create(user, slug='sms')
+            assert_equal(len(token.key), 3)
+            assert_equal(received[1]['adapted_length'], 3)
+
+            # stale count is reloaded by another thread, the check is skipped without waiting
+            keyspace.reset()
+            keyspace._reload_lock.acquire()
+            try:
+                with self.assertNumQueries(0):
+                    assert_equal(keyspace.check_keyspace('sms', {'length': 2}), {'length': 2})
+            finally:
+                keyspace._reload_lock.release()
+        finally:
+            keyspace_exhausting.disconnect(receiver)
+            keyspace.reset()
+
+    @skipUnless(connection.vendor == 'sqlite', 'Statistics are checked only in SQLite')
+    @data_consumer('create_user')
+    def test_live_token_count_should_be_estimated_by_database_statistics(self, user):
+        VerificationToken.objects.bulk_create([
+            VerificationToken(content_object=user, key='KEY{}'.format(i)) for i in range(30)
+        ])
+        keyspace.reset()
+        try:
+            # tokens are counted before the table is analyzed
+            assert_equal(keyspace._load_live_token_count(), 30)
+
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+            VerificationToken.objects.bulk_create([
+                VerificationToken(content_object=user, key='NEW_KEY{}'.format(i)) for i in range(10)
+            ])
+            keyspace.reset()
+            with CaptureQueriesContext(connection) as queries:
+                assert_equal(keyspace._load_live_token_count(), 30)
+            assert_equal(len(queries), 1)
+            assert_true('sqlite_stat1' in queries[0]['sql'])
+        finally:
+            keyspace.reset()
+
+    @data_consumer('create_user')
+    @override_settings(VERIFICATION_TOKEN_GENERATION_REVOCATION=True)
+    def test_deactivate_should_revoke_tokens_by_generation_increment(self, user):
+        other_user = User.objects.create_user('other')
+        other_token = VerificationToken.objects.deactivate_and_create(other_user)
+        tokens = [
+            VerificationToken.objects.deactivate_and_create(user, deactivate_old_tokens=False) for _ in range(3)
+        ]
+        assert_true(all(VerificationToken.objects.exists_valid(user, token.key) for token in tokens))
+
+        # token rows are not updated
+        assert_is_none(VerificationToken.objects.deactivate(user))
+        assert_equal(VerificationToken.objects.filter(is_active=True).count(), 4)
+        for token in tokens:
+            assert_false(VerificationToken.objects.exists_valid(user, token.key))
+            assert_is_none(VerificationToken.objects.verify_key(token.key))
+            assert_false(VerificationToken.objects.get(pk=token.pk).is_valid)
+        assert_equal(set(VerificationToken.objects.revoked()), set(tokens))
+        assert_equal(VerificationToken.objects.verify_key(other_token.key), other_token)
+        # generation row exists, only one row is updated
+        with self.assertNumQueries(1):
+            VerificationToken.objects.deactivate(user)
+
+        token = VerificationToken.objects.deactivate_and_create(user)
+        assert_equal(token.generation, 3)
+        assert_true(VerificationToken.objects.exists_valid(user, token.key))
+        assert_true(token.is_valid)
+        assert_equal(VerificationToken.objects.get_active_or_create(user), token)
+        assert_equal(VerificationToken.objects.deactivate(user, key=token.key), 1)
+        assert_false(VerificationToken.objects.exists_valid(user, token.key))
+
+    @data_consumer('create_user')
+    @override_settings(VERIFICATION_TOKEN_GENERATION_REVOCATION=True)
+    def test_revocation_check_should_not_query_generation_per_token(self, user):
+        users = [user] + [User.objects.create_user('user{}'.format(i)) for i in range(4)]
+        VerificationToken.objects.bulk_deactivate_and_create(users)
+        VerificationToken.objects.deactivate(users[0])
+
+        with self.assertNumQueries(1):
+            tokens = list(VerificationToken.objects.active())
+            assert_true(all(token.is_valid for token in tokens))
+        assert_equal(len(tokens), 4)
+        with self.assertNumQueries(1):
+            assert_equal(len([token for token in VerificationToken.objects.valid() if not token.is_revoked]), 4)
+        with self.assertNumQueries(1):
+            assert_equal(len(VerificationToken.objects.filter_active_tokens(User)), 4)
+
+        token = VerificationToken.objects.get(object_id=users[0].pk)
+        with self.assertNumQueries(1):
+            assert_true(token.is_revoked)
+            assert_false(token.is_valid)
+
+    @data_consumer('create_user')
+    def test_queryset_should_compute_validity_in_database(self, user):
+        other_user = User.objects.create_user('other')
+        valid_token = VerificationToken.objects.deactivate_and_create(user, slug='a', deactivate_old_tokens=False)
+        other_token = VerificationToken.objects.deactivate_and_create(other_user, slug='a')
+        slug_token = VerificationToken.objects.deactivate_and_create(user, slug='b')
+        inactive_token = VerificationToken.objects.deactivate_and_create(user, slug='a', deactivate_old_tokens=False)
+        VerificationToken.objects.deactivate(user, slug='a', key=inactive_token.key)
+        with freeze_time(timezone.now() - timedelta(days=1)):
+            expired_token = VerificationToken.objects.deactivate_and_create(
+                user, slug='a', deactivate_old_tokens=False, expiration_in_minutes=1
+            )
+
+        tokens = VerificationToken.objects.for_object(user).for_slug('a')
+        assert_equal(set(tokens), {valid_token, inactive_token, expired_token})
+        assert_equal(set(tokens.active()), {valid_token, expired_token})
+        assert_equal(set(tokens.valid()), {valid_token})
+        assert_equal(set(tokens.expired()), {expired_token})
+        assert_equal(set(tokens.valid(now=timezone.now() - timedelta(days=1))), {valid_token, expired_token})
+        assert_equal(set(VerificationToken.objects.for_object(User).valid()), {valid_token, other_token, slug_token})
+        for token in VerificationToken.objects.annotate_is_valid():
+            assert_equal(token.is_currently_valid, token.is_valid)
+
+    @data_consumer('create_user')
+    @override_settings(VERIFICATION_TOKEN_VALIDITY_CACHE=True)
+    def test_exists_valid_should_use_write_through_validity_cache(self, user):
+        cache.clear()
+        # validity cache is updated when the transaction is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            token = VerificationToken.objects.deactivate_and_create(user)
+        # issued token is written to the cache
+        with self.assertNumQueries(0):
+            assert_true(VerificationToken.objects.exists_valid(user, token.key))
+
+        # negative result is cached too and it is overwritten by the issued token
+        with self.assertNumQueries(1):
+            assert_false(VerificationToken.objects.exists_valid(user, 'test'))
+        with self.assertNumQueries(0):
+            assert_false(VerificationToken.objects.exists_valid(user, 'test'))
+        with self.captureOnCommitCallbacks(execute=True):
+            VerificationToken.objects.deactivate_and_create(
+                user, deactivate_old_tokens=False, key_generator_kwargs={'generator': test_generator}
+            )
+        with self.assertNumQueries(0):
+            assert_true(VerificationToken.objects.exists_valid(user, 'test'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            assert_true(VerificationToken.objects.consume(user, 'test'))
+        assert_false(VerificationToken.objects.exists_valid(user, 'test'))
+        assert_true(VerificationToken.objects.exists_valid(user, token.key))
+        with self.captureOnCommitCallbacks(execute=True):
+            VerificationToken.objects.deactivate(user)
+        assert_false(VerificationToken.objects.exists_valid(user, token.key))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            token = VerificationToken.objects.deactivate_and_create(user)
+            VerificationToken.objects.bulk_deactivate_and_create([user])
+        assert_false(VerificationToken.objects.exists_valid(user, token.key))
+
+    @data_consumer('create_user')
+    @override_settings(VERIFICATION_TOKEN_VALIDITY_CACHE=True)
+    def test_validity_cache_should_be_updated_after_commit(self, user):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            token = VerificationToken.objects.deactivate_and_create(user)
+        assert_true(VerificationToken.objects.exists_valid(user, token.key))
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with transaction.atomic():
+                VerificationToken.objects.deactivate(user)
+                # concurrent verification before the commit caches the result under the current version
+                assert_equal(len(callbacks), 0)
+                VerificationToken.objects.filter(pk=token.pk).update(is_active=True)
+                assert_true(VerificationToken.objects.exists_valid(user, token.key))
+                VerificationToken.objects.filter(pk=token.pk).update(is_active=False)
+        assert_false(VerificationToken.objects.exists_valid(user, token.key))
+
+        # rolled back token is not written to the cache
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with assert_raises(IntegrityError):
+                with transaction.atomic():
+                    rolled_back_token = VerificationToken.objects.deactivate_and_create(user)
+                    raise IntegrityError
+        assert_equal(len(callbacks), 0)
+        assert_false(VerificationToken.objects.exists_valid(user, rolled_back_token.key))
+
+    @data_consumer('create_user')
+    @override_settings(VERIFICATION_TOKEN_VALIDITY_CACHE=True)
+    def test_validity_cache_should_not_serve_result_if_version_is_evicted(self, user):
+        cache.clear()
+        # token is cached before any version of the object tokens is set
+        with self.captureOnCommitCallbacks(execute=True):
+            token = VerificationToken.objects.deactivate_and_create(user, deactivate_old_tokens=False)
+        assert_true(VerificationToken.objects.exists_valid(user, token.key))
+        with self.captureOnCommitCallbacks(execute=True):
+            VerificationToken.objects.deactivate(user)
+        # version key is evicted after the invalidation, the stale valid entry must not be used
+        cache.delete(validity_cache._get_version_key(ContentType.objects.get_for_model(User).pk, str(user.pk), None))
+        assert_false(VerificationToken.objects.exists_valid(user, token.key))
@@ -0,0 +1,152 @@
+from contextlib import contextmanager
+
+from django.contrib.auth.models import Group, User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+
+from germanium.decorators import data_consumer
+from germanium.test_cases.default import GermaniumTestCase
+from germanium.tools import assert_equal
+from verification_token.models import VerificationToken
+
+from .base import BaseTestCaseMixin
+
+
+__all__ = (
+    'TokenQueriesTestCase',
+)
+
+
+@contextmanager
+def assert_num_queries(num):
+    """
+    Savepoints are not counted, in autocommit mode they are not executed.
+    """
+    with CaptureQueriesContext(connection) as context:
+        yield
+    queries = [query['sql'] for query in context.captured_queries if 'SAVEPOINT' not in query['sql']]
+    assert_equal(len(queries), num, 'Unexpected number of queries:\n{}'.format('\n'.join(queries)))
+
+
+class TokenQueriesTestCase(BaseTestCaseMixin, GermaniumTestCase):
+    """
+    Pins number of queries of the manager methods, content type of the object is always cached.
+    """
+
+    def setUp(self):
+        super().setUp()
+        ContentType.objects.get_for_model(User)
+
+    @data_consumer('create_user')
+    def test_deactivate_queries(self, user):
+        VerificationToken.objects.deactivate_and_create(user)
+        with assert_num_queries(1):
+            VerificationToken.objects.deactivate(user)
+
+    @data_consumer('create_user')
+    def test_deactivate_and_create_queries(self, user):
+        # deactivation, key uniqueness check, insert
+        with assert_num_queries(3):
+            VerificationToken.objects.deactivate_and_create(user)
+        with assert_num_queries(2):
+            VerificationToken.objects.deactivate_and_create(user, deactivate_old_tokens=False)
+
+    @data_consumer('create_user')
+    @override_settings(VERIFICATION_TOKEN_OPTIMISTIC_KEY_GENERATION=True)
+    def test_deactivate_and_create_with_optimistic_key_generation_queries(self, user):
+        with assert_num_queries(2):
+            VerificationToken.objects.deactivate_and_create(user)
+        with assert_num_queries(1):
+            VerificationToken.objects.deactivate_and_create(user, deactivate_old_tokens=False)
+
+    @data_consumer('create_user')
+    def test_get_active_or_create_queries(self, user):
+        # select of valid token, lock update and insert of the lock row (valid token can't be created under the new
+        # lock), key uniqueness check, insert
+        with assert_num_queries(5):
+            VerificationToken.objects.get_active_or_create(user)
+        with assert_num_queries(1):
+            VerificationToken.objects.get_active_or_create(user)
+        VerificationToken.objects.deactivate(user)
+        # lock row exists, valid token is selected again under the lock
+        with assert_num_queries(5):
+            VerificationToken.objects.get_active_or_create(user)
+        with override_settings(VERIFICATION_TOKEN_OPTIMISTIC_KEY_GENERATION=True):
+            VerificationToken.objects.deactivate(user)
+            with assert_num_queries(4):
+                VerificationToken.objects.get_active_or_create(user)
+
+    @data_consumer('create_user')
+    def test_bulk_deactivate_and_create_queries(self, user):
+        users = [user] + [User.objects.create_user('user{}'.format(i)) for i in range(4)]
+        # deactivation, key uniqueness check, insert per batch
+        with assert_num_queries(6):
+            VerificationToken.objects.bulk_deactivate_and_create(users, batch_size=3)
+
+    @data_consumer('create_user')
+    def test_exists_valid_queries(self, user):
+        token = VerificationToken.objects.deactivate_and_create(user)
+        with assert_num_queries(1):
+            VerificationToken.objects.exists_valid(user, token.key)
+        with assert_num_queries(1):
+            VerificationToken.objects.exists_valid(user, 'invalid')
+        with assert_num_queries(0):
+            VerificationToken.objects.exists_valid(user, None)
+
+    @data_consumer('create_user')
+    def test_consume_queries(self, user):
+        token = VerificationToken.objects.deactivate_and_create(user)
+        with assert_num_queries(1):
+            VerificationToken.objects.consume(user, token.key)
+
+        token = VerificationToken.objects.deactivate_and_create(user)
+        with assert_num_queries(1 if VerificationToken.objects.all()._supports_update_returning() else 2):
+            VerificationToken.objects.consume(user, token.key, return_extra_data=True)
+
+    @data_consumer('create_user')
+    def test_filter_active_tokens_queries(self, user):
+        VerificationToken.objects.deactivate_and_create(user)
+        with assert_num_queries(1):
+            list(VerificationToken.objects.filter_active_tokens(user))
+
+    @data_consumer('create_user')
+    def test_save_queries(self, user):
+        token = VerificationToken(content_type=ContentType.objects.get_for_model(User), object_id=user.pk)
+        # key uniqueness check, insert
+        with assert_num_queries(2):
+            token.save()
+        with assert_num_queries(1):
+            token.save()
+
+        with override_settings(VERIFICATION_TOKEN_OPTIMISTIC_KEY_GENERATION=True):
+            token = VerificationToken(content_type=ContentType.objects.get_for_model(User), object_id=user.pk)
+            with assert_num_queries(1):
+                token.save()
+
+    @data_consumer('create_user')
+    def test_verify_key_queries(self, user):
+        token = VerificationToken.objects.deactivate_and_create(user, slug='a')
+        # select of token, select of object
+        with assert_num_queries(2):
+            verified_token = VerificationToken.objects.verify_key(token.key, slug='a')
+            assert_equal(verified_token.content_object, user)
+        # select of token, consume update, select of object
+        with assert_num_queries(3):
+            VerificationToken.objects.verify_key(token.key, slug='a', consume=True)
+        with assert_num_queries(1):
+            VerificationToken.objects.verify_key(token.key, slug='a')
+
+    def test_prefetch_content_objects_queries(self):
+        users = [User.objects.create_user('user{}'.format(i)) for i in range(3)]
+        groups = [Group.objects.create(name='group{}'.format(i)) for i in range(3)]
+        VerificationToken.objects.bulk_deactivate_and_create(users)
+        VerificationToken.objects.bulk_deactivate_and_create(groups)
+        ContentType.objects.get_for_model(Group)
+        # select of tokens, select of users, select of groups
+        with assert_num_queries(3):
+            assert_equal(
+                {token.content_object for token in VerificationToken.objects.prefetch_content_objects()},
+                set(users) | set(groups)
+            )
@@ -22,10 +22,12 @@ setup(
         'License :: OSI Approved :: BSD License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3 :: Only',
         'Topic :: Internet :: WWW/HTTP',
     ],
+    python_requires='>=3.8',
     install_requires=[
-        'django>=1.11',
+        'django>=4.2',
     ],
     zip_safe=False
 )
@@ -0,0 +1,17 @@
+from functools import lru_cache
+
+from django.utils.module_loading import import_string
+
+from verification_token.config import settings
+
+
+@lru_cache()
+def _load_backend(path):
+    return import_string(path)()
+
+
+def get_backend():
+    """
+    Returns instance of the verification tokens backend configured with setting STORAGE_BACKEND.
+    """
+    return _load_backend(settings.STORAGE_BACKEND)
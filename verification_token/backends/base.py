@@ -0,0 +1,62 @@
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+
+
+class Token:
+    """
+    Verification token of a backend which doesn't store tokens as VerificationToken instances
+    """
+
+    def __init__(self, key, content_type, object_id, slug=None, expires_at=None, extra_data=None, is_active=True,
+                 created_at=None):
+        self.key = key
+        self.created_at = created_at
+        self.content_type = content_type
+        self.object_id = object_id
+        self.slug = slug
+        self.expires_at = expires_at
+        self.extra_data = extra_data
+        self.is_active = is_active
+
+    @property
+    def is_valid(self):
+        return (
+            self.is_active and self.key and (self.expires_at is None or timezone.now() <= self.expires_at)
+        )
+
+    def check_key(self, key):
+        """
+        Returns True if verification key is correct and not expired
+        """
+        return bool(self.is_valid and key and constant_time_compare(self.key, key))
+
+    def get_extra_data(self):
+        return self.extra_data
+
+    def __str__(self):
+        return self.key
+
+
+class BaseTokenBackend:
+    """
+    Verification tokens backend with the VerificationTokenManager API
+    """
+
+    def deactivate(self, obj, slug=None, key=None):
+        raise NotImplementedError
+
+    def deactivate_and_create(self, obj, slug=None, extra_data=None, deactivate_old_tokens=True,
+                              key_generator_kwargs=None, **kwargs):
+        raise NotImplementedError
+
+    def get_active_or_create(self, obj, slug=None, extra_data=None, key=None, key_generator_kwargs=None, **kwargs):
+        raise NotImplementedError
+
+    def exists_valid(self, obj, key, slug=None):
+        raise NotImplementedError
+
+    def consume(self, obj, key, slug=None):
+        raise NotImplementedError
+
+    def filter_active_tokens(self, obj_or_class, slug=None, key=None):
+        raise NotImplementedError
@@ -0,0 +1,187 @@
+import math
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.db import models
+from django.db.utils import IntegrityError
+from django.utils import timezone
+
+from verification_token.config import settings
+from verification_token.models import VerificationToken
+
+from .base import BaseTokenBackend, Token
+
+
+def _to_timestamp(value):
+    return value.timestamp() if value is not None else None
+
+
+def _from_timestamp(value):
+    return datetime.fromtimestamp(value, tz=dt_timezone.utc) if value is not None else None
+
+
+class CacheTokenBackend(BaseTokenBackend):
+    """
+    Backend which stores tokens in the Django cache (setting STORAGE_CACHE_ALIAS). Cache timeout of the token is set
+    according to its expiration, therefore expired tokens don't need to be cleaned. Keys of the object tokens are
+    stored in the index cache entry of the object and slug which is used for deactivation and token filtering.
+
+    Index entries are updated without locking, concurrent issuing of tokens for the same object and slug can therefore
+    lose a key from the index.
+    """
+
+    key_prefix = 'verification_token'
+
+    @property
+    def cache(self):
+        return caches[settings.STORAGE_CACHE_ALIAS]
+
+    def _get_token_cache_key(self, key):
+        return '{}:token:{}'.format(self.key_prefix, key)
+
+    def _get_index_cache_key(self, content_type, object_id, slug):
+        return '{}:index:{}:{}:{}'.format(self.key_prefix, content_type.pk, object_id, slug or '')
+
+    def _get_timeout(self, expires_at):
+        return None if expires_at is None else max(math.ceil((expires_at - timezone.now()).total_seconds()), 1)
+
+    def _get_object_lookup(self, obj):
+        if not isinstance(obj, models.Model):
+            raise TypeError('Cache backend supports only tokens lookup by object instance, {!r} was given'.format(obj))
+        return ContentType.objects.get_for_model(obj.__class__), str(obj.pk)
+
+    def _deserialize_token(self, key, data):
+        return Token(
+            key=key,
+            content_type=ContentType.objects.get_for_id(data['content_type']),
+            object_id=data['object_id'],
+            slug=data['slug'],
+            expires_at=_from_timestamp(data['expires_at']),
+            extra_data=data['extra_data'],
+            created_at=_from_timestamp(data['created_at']),
+        )
+
+    def _matches(self, data, content_type, object_id, slug, check_expiration=True):
+        return (
+            data is not None
+            and data['content_type'] == content_type.pk
+            and data['object_id'] == object_id
+            and data['slug'] == slug
+            and (
+                not check_expiration or data['expires_at'] is None or timezone.now().timestamp() <= data['expires_at']
+            )
+        )
+
+    def _get_index(self, content_type, object_id, slug):
+        return self.cache.get(self._get_index_cache_key(content_type, object_id, slug), {})
+
+    def _set_index(self, content_type, object_id, slug, index):
+        now = timezone.now().timestamp()
+        # keys of expired tokens are removed from the index
+        index = {key: expires_at for key, expires_at in index.items() if expires_at is None or expires_at >= now}
+        index_cache_key = self._get_index_cache_key(content_type, object_id, slug)
+        if not index:
+            self.cache.delete(index_cache_key)
+        elif None in index.values():
+            self.cache.set(index_cache_key, index, None)
+        else:
+            self.cache.set(index_cache_key, index, max(math.ceil(max(index.values()) - now), 1))
+
+    def _remove_from_index(self, content_type, object_id, slug, keys):
+        index = self._get_index(content_type, object_id, slug)
+        if any(key in index for key in keys):
+            self._set_index(content_type, object_id, slug, {
+                key: expires_at for key, expires_at in index.items() if key not in keys
+            })
+
+    def deactivate(self, obj, slug=None, key=None):
+        content_type, object_id = self._get_object_lookup(obj)
+        if key:
+            # token of another object or slug is not deactivated
+            keys = [key] if self._matches(
+                self.cache.get(self._get_token_cache_key(key)), content_type, object_id, slug, check_expiration=False
+            ) else []
+        else:
+            keys = list(self._get_index(content_type, object_id, slug).keys())
+        if keys:
+            self.cache.delete_many([self._get_token_cache_key(key) for key in keys])
+            self._remove_from_index(content_type, object_id, slug, keys)
+
+    def deactivate_and_create(self, obj, slug=None, extra_data=None, deactivate_old_tokens=True,
+                              key_generator_kwargs=None, **kwargs):
+        if deactivate_old_tokens:
+            self.deactivate(obj, slug)
+
+        return self._create(obj, slug=slug, extra_data=extra_data, key_generator_kwargs=key_generator_kwargs, **kwargs)
+
+    def get_active_or_create(self, obj, slug=None, extra_data=None, key=None, key_generator_kwargs=None, **kwargs):
+        tokens = self.filter_active_tokens(obj, slug, key)
+        if tokens:
+            return max(tokens, key=lambda token: token.created_at)
+        else:
+            return self._create(obj, slug=slug, extra_data=extra_data, key_generator_kwargs=key_generator_kwargs,
+                                **kwargs)
+
+    def _create(self, obj, slug=None, extra_data=None, key_generator_kwargs=None, **kwargs):
+        expiration_in_minutes = kwargs.pop('expiration_in_minutes', settings.get_expiration(slug))
+        key_generator_kwargs = settings.get_key_generator_kwargs(slug, key_generator_kwargs)
+        generator_func = VerificationToken.get_key_generator(key_generator_kwargs.pop('generator', None))
+
+        content_type, object_id = self._get_object_lookup(obj)
+        now = timezone.now()
+        expires_at = (now + timedelta(minutes=expiration_in_minutes)) if expiration_in_minutes else None
+        data = {
+            'content_type': content_type.pk,
+            'object_id': object_id,
+            'slug': slug,
+            'expires_at': _to_timestamp(expires_at),
+            'extra_data': extra_data,
+            'created_at': _to_timestamp(now),
+        }
+        timeout = self._get_timeout(expires_at)
+        for _ in range(settings.MAX_RANDOM_KEY_ITERATIONS):
+            key = generator_func(**key_generator_kwargs)
+            # add is atomic, existing key is not overwritten
+            if self.cache.add(self._get_token_cache_key(key), data, timeout):
+                break
+        else:
+            raise IntegrityError('Could not produce unique key for verification token')
+
+        index = self._get_index(content_type, object_id, slug)
+        index[key] = data['expires_at']
+        self._set_index(content_type, object_id, slug, index)
+        return self._deserialize_token(key, data)
+
+    def _exists_valid(self, content_type, object_id, key, slug):
+        return bool(key) and self._matches(
+            self.cache.get(self._get_token_cache_key(key)), content_type, object_id, slug
+        )
+
+    def exists_valid(self, obj, key, slug=None):
+        content_type, object_id = self._get_object_lookup(obj)
+        return self._exists_valid(content_type, object_id, key, slug)
+
+    def consume(self, obj, key, slug=None):
+        """
+        Removes the valid token and its key from the object index, only one of concurrent calls deletes the token and
+        returns True.
+        """
+        content_type, object_id = self._get_object_lookup(obj)
+        if not self._exists_valid(content_type, object_id, key, slug) or not self.cache.delete(
+            self._get_token_cache_key(key)
+        ):
+            return False
+        self._remove_from_index(content_type, object_id, slug, [key])
+        return True
+
+    def filter_active_tokens(self, obj_or_class, slug=None, key=None):
+        content_type, object_id = self._get_object_lookup(obj_or_class)
+        keys = [key] if key else list(self._get_index(content_type, object_id, slug).keys())
+        cached_tokens = self.cache.get_many([self._get_token_cache_key(key) for key in keys])
+        return [
+            self._deserialize_token(key, cached_tokens[self._get_token_cache_key(key)])
+            for key in keys
+            if self._matches(cached_tokens.get(self._get_token_cache_key(key)), content_type, object_id, slug)
+        ]
@@ -0,0 +1,33 @@
+from verification_token.models import VerificationToken
+
+from .base import BaseTokenBackend
+
+
+class ORMTokenBackend(BaseTokenBackend):
+    """
+    Default backend, tokens are stored in the database as VerificationToken instances.
+    """
+
+    def deactivate(self, obj, slug=None, key=None):
+        return VerificationToken.objects.deactivate(obj, slug=slug, key=key)
+
+    def deactivate_and_create(self, obj, slug=None, extra_data=None, deactivate_old_tokens=True,
+                              key_generator_kwargs=None, **kwargs):
+        return VerificationToken.objects.deactivate_and_create(
+            obj, slug=slug, extra_data=extra_data, deactivate_old_tokens=deactivate_old_tokens,
+            key_generator_kwargs=key_generator_kwargs, **kwargs
+        )
+
+    def get_active_or_create(self, obj, slug=None, extra_data=None, key=None, key_generator_kwargs=None, **kwargs):
+        return VerificationToken.objects.get_active_or_create(
+            obj, slug=slug, extra_data=extra_data, key=key, key_generator_kwargs=key_generator_kwargs, **kwargs
+        )
+
+    def exists_valid(self, obj, key, slug=None):
+        return VerificationToken.objects.exists_valid(obj, key, slug=slug)
+
+    def consume(self, obj, key, slug=None):
+        return VerificationToken.objects.consume(obj, key, slug=slug)
+
+    def filter_active_tokens(self, obj_or_class, slug=None, key=None, **extra_data_lookups):
+        return VerificationToken.objects.filter_active_tokens(obj_or_class, slug=slug, key=key, **extra_data_lookups)
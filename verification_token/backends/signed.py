@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+
+from django.contrib.contenttypes.models import ContentType
+from django.core import signing
+from django.utils import timezone
+
+from verification_token.config import settings
+from verification_token.models import VerificationTokenGeneration
+
+from .base import BaseTokenBackend, Token
+
+
+class SignedTokenBackend(BaseTokenBackend):
+    """
+    Stateless backend, token data are stored in the HMAC signed key. Verification of a token doesn't write to the
+    database, tokens are revoked by incrementing the object generation counter (one row update). The key is signed
+    but not encrypted, extra data can be read by the token holder and mustn't contain sensitive data.
+    """
+
+    salt = 'verification_token.backends.signed'
+
+    def deactivate(self, obj, slug=None, key=None):
+        """
+        Revokes all tokens of the object with the slug, single tokens can't be revoked. Returns the new generation.
+        """
+        return VerificationTokenGeneration.objects.increment(obj, slug)
+
+    def deactivate_and_create(self, obj, slug=None, extra_data=None, deactivate_old_tokens=True,
+                              key_generator_kwargs=None, **kwargs):
+        # the generation is written only if the old tokens are revoked
+        generation = (
+            self.deactivate(obj, slug) if deactivate_old_tokens
+            else VerificationTokenGeneration.objects.get_generation(obj, slug)
+        )
+
+        expiration_in_minutes = kwargs.pop('expiration_in_minutes', settings.get_expiration(slug))
+        expires_at = (timezone.now() + timedelta(minutes=expiration_in_minutes)) if expiration_in_minutes else None
+        content_type = ContentType.objects.get_for_model(obj.__class__)
+        key = signing.dumps(
+            (
+                content_type.pk,
+                str(obj.pk),
+                slug,
+                expires_at.timestamp() if expires_at else None,
+                generation,
+                extra_data,
+            ),
+            salt=self.salt,
+            compress=True,
+        )
+        return Token(
+            key=key, content_type=content_type, object_id=str(obj.pk), slug=slug, expires_at=expires_at,
+            extra_data=extra_data
+        )
+
+    def _load(self, key):
+        try:
+            return signing.loads(key, salt=self.salt)
+        except signing.BadSignature:
+            return None
+
+    def get_token(self, key):
+        """
+        Returns token with data decoded from the signed key or None if the key signature is invalid.
+        """
+        payload = self._load(key)
+        if payload is None:
+            return None
+
+        content_type_id, object_id, slug, expires_at, _, extra_data = payload
+        return Token(
+            key=key,
+            content_type=ContentType.objects.get_for_id(content_type_id),
+            object_id=object_id,
+            slug=slug,
+            expires_at=datetime.fromtimestamp(expires_at, tz=dt_timezone.utc) if expires_at is not None else None,
+            extra_data=extra_data,
+        )
+
+    def exists_valid(self, obj, key, slug=None):
+        payload = self._load(key) if key else None
+        if payload is None:
+            return False
+
+        content_type_id, object_id, token_slug, expires_at, generation, _ = payload
+        return (
+            content_type_id == ContentType.objects.get_for_model(obj.__class__).pk
+            and object_id == str(obj.pk)
+            and token_slug == slug
+            and (expires_at is None or timezone.now().timestamp() <= expires_at)
+            and generation == VerificationTokenGeneration.objects.get_generation(obj, slug)
+        )
@@ -1,6 +1,9 @@
 import string
 
 from django.conf import settings as django_settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
 
 
 DEFAULTS = {
@@ -9,19 +12,180 @@ DEFAULTS = {
     'DEFAULT_KEY_CHARS': string.ascii_uppercase + string.digits,  # Allowed token key characters
     'DEFAULT_KEY_GENERATOR': 'verification_token.generators.random_string_generator',  # Token key generator
     'DEFAULT_EXPIRATION': 24 * 60,  # Default token expiration in minutes
+    'OPTIMISTIC_KEY_GENERATION': False,  # Insert token immediately and generate key again only on collision
+    'STORAGE_BACKEND': 'verification_token.backends.orm.ORMTokenBackend',  # Backend used by get_backend()
+    'STORAGE_CACHE_ALIAS': 'default',  # Django cache used by the cache storage backend
+    'METRICS_SINK': None,  # Path to the verification_token.metrics.BaseMetricsSink subclass
+    'SLUG_PROFILES': {},  # Token settings per slug (keys EXPIRATION, KEY_LENGTH, KEY_CHARS, KEY_GENERATOR, SCOPED_KEYS)
+    'HASHED_KEYS': False,  # Store only the selector and SHA-256 digest of the new token keys
+    'KEYSPACE_RETRIES_THRESHOLD': None,  # Expected key generator retries which trigger keyspace warning
+    'KEYSPACE_CHECK_INTERVAL': 60,  # Seconds the live token count used by the keyspace check is cached
+    'KEYSPACE_ADAPTIVE_LENGTH': False,  # Increase key length of the slug if the keyspace threshold is exceeded
+    'GENERATION_REVOCATION': False,  # Deactivate object tokens by incrementing the generation of object and slug
+    'VALIDITY_CACHE': False,  # Cache results of exists_valid in the Django cache
+    'VALIDITY_CACHE_ALIAS': 'default',  # Django cache used by the validity cache
+    'VALIDITY_CACHE_NEGATIVE_TIMEOUT': 5,  # Seconds missing and expired tokens are cached, None disables it
+    'KEY_RESERVOIR': False,  # Issue tokens with keys pre-generated by command fill_verification_token_key_reservoir
+    'KEY_RESERVOIR_SIZE': 10000,  # Number of keys the reservoir is filled to
+    'KEY_RESERVOIR_LOW_WATERMARK': 1000,  # Reservoir is refilled when it contains fewer keys
+    'KEY_RESERVOIR_CLAIM_SIZE': 10,  # Number of reserved keys claimed by a process with one query
+}
+
+PROFILE_KEYS = {'EXPIRATION', 'KEY_LENGTH', 'KEY_CHARS', 'KEY_GENERATOR', 'SCOPED_KEYS'}
+
+
+def _validate_positive_int(name, value, max_value=None):
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1 or (max_value and value > max_value):
+        raise ImproperlyConfigured('VERIFICATION_TOKEN {} must be a positive integer{}'.format(
+            name, ' not greater than {}'.format(max_value) if max_value else ''
+        ))
+    return value
+
+
+def _validate_positive_number(name, value):
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0:
+        raise ImproperlyConfigured('VERIFICATION_TOKEN {} must be a positive number'.format(name))
+    return value
+
+
+def _validate_optional_positive_number(name, value):
+    return value if value is None else _validate_positive_number(name, value)
+
+
+def _validate_expiration(name, value):
+    return value if value is None else _validate_positive_int(name, value)
+
+
+def _validate_key_length(name, value):
+    # key field max_length
+    return _validate_positive_int(name, value, 100)
+
+
+def _validate_key_chars(name, value):
+    if not isinstance(value, str) or not value:
+        raise ImproperlyConfigured('VERIFICATION_TOKEN {} must be a non-empty string'.format(name))
+    return value
+
+
+def _validate_bool(name, value):
+    if not isinstance(value, bool):
+        raise ImproperlyConfigured('VERIFICATION_TOKEN {} must be a boolean'.format(name))
+    return value
+
+
+def _resolve_generator(name, value):
+    try:
+        value = import_string(value) if isinstance(value, str) else value
+    except ImportError as ex:
+        raise ImproperlyConfigured('VERIFICATION_TOKEN {} cannot be imported: {}'.format(name, ex))
+    if not callable(value):
+        raise ImproperlyConfigured('VERIFICATION_TOKEN {} must be a callable or path to a callable'.format(name))
+    return value
+
+
+PROFILE_VALIDATORS = {
+    'EXPIRATION': _validate_expiration,
+    'KEY_LENGTH': _validate_key_length,
+    'KEY_CHARS': _validate_key_chars,
+    'KEY_GENERATOR': _resolve_generator,
+    'SCOPED_KEYS': _validate_bool,
+}
+
+
+def _resolve_slug_profiles(name, value):
+    profiles = {}
+    for slug, profile in value.items():
+        unknown_keys = set(profile) - PROFILE_KEYS
+        if unknown_keys:
+            raise ImproperlyConfigured('Invalid VERIFICATION_TOKEN {} keys of slug "{}": {}'.format(
+                name, slug, ', '.join(sorted(unknown_keys))
+            ))
+        profiles[slug] = {
+            key: PROFILE_VALIDATORS[key]('{}["{}"]["{}"]'.format(name, slug, key), profile_value)
+            for key, profile_value in profile.items()
+        }
+    return profiles
+
+
+VALIDATORS = {
+    'MAX_RANDOM_KEY_ITERATIONS': _validate_positive_int,
+    'DEFAULT_KEY_LENGTH': _validate_key_length,
+    'DEFAULT_KEY_CHARS': _validate_key_chars,
+    'DEFAULT_KEY_GENERATOR': _resolve_generator,
+    'DEFAULT_EXPIRATION': _validate_expiration,
+    'SLUG_PROFILES': _resolve_slug_profiles,
+    'KEYSPACE_RETRIES_THRESHOLD': _validate_optional_positive_number,
+    'KEYSPACE_CHECK_INTERVAL': _validate_positive_number,
+    'VALIDITY_CACHE_NEGATIVE_TIMEOUT': _validate_optional_positive_number,
+    'KEY_RESERVOIR_SIZE': _validate_positive_int,
+    'KEY_RESERVOIR_LOW_WATERMARK': _validate_positive_int,
+    'KEY_RESERVOIR_CLAIM_SIZE': _validate_positive_int,
 }
 
 
 class Settings:
+    """
+    Settings are resolved and validated on the first access and cached until a VERIFICATION_TOKEN setting changes.
+    Generator paths are returned as imported callables.
+    """
+
+    def __init__(self):
+        self._cache = {}
 
     def __getattr__(self, attr):
         if attr not in DEFAULTS:
             raise AttributeError('Invalid VERIFICATION_TOKEN setting: "{}"'.format(attr))
 
-        default = DEFAULTS[attr]
-        return getattr(
-            django_settings, 'VERIFICATION_TOKEN_{}'.format(attr), default(self) if callable(default) else default
-        )
+        try:
+            return self._cache[attr]
+        except KeyError:
+            default = DEFAULTS[attr]
+            value = getattr(
+                django_settings, 'VERIFICATION_TOKEN_{}'.format(attr), default(self) if callable(default) else default
+            )
+            if attr in VALIDATORS:
+                value = VALIDATORS[attr](attr, value)
+            self._cache[attr] = value
+            return value
+
+    def reload(self):
+        self._cache = {}
+
+    def get_slug_profile(self, slug):
+        return self.SLUG_PROFILES.get(slug, {})
+
+    def get_expiration(self, slug=None):
+        """
+        Returns token expiration in minutes of the slug profile or the default expiration.
+        """
+        profile = self.get_slug_profile(slug)
+        return profile['EXPIRATION'] if 'EXPIRATION' in profile else self.DEFAULT_EXPIRATION
+
+    def has_scoped_keys(self, slug=None):
+        """
+        Returns True if keys of the slug tokens are unique only among active tokens of the object and slug.
+        """
+        return self.get_slug_profile(slug).get('SCOPED_KEYS', False)
+
+    def get_key_generator_kwargs(self, slug=None, key_generator_kwargs=None):
+        """
+        Returns key generator kwargs of the slug profile updated with key_generator_kwargs.
+        """
+        profile = self.get_slug_profile(slug)
+        profile_kwargs = {
+            kwarg: profile[key]
+            for key, kwarg in (('KEY_GENERATOR', 'generator'), ('KEY_LENGTH', 'length'), ('KEY_CHARS', 'allowed_chars'))
+            if key in profile
+        }
+        return {**profile_kwargs, **(key_generator_kwargs or {})}
 
 
 settings = Settings()
+
+
+def reload_settings(setting, **kwargs):
+    if setting.startswith('VERIFICATION_TOKEN_'):
+        settings.reload()
+
+
+setting_changed.connect(reload_settings)
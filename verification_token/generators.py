@@ -1,3 +1,5 @@
+import os
+
 from django.utils.crypto import get_random_string
 
 from .config import settings
@@ -8,3 +10,58 @@ def random_string_generator(length=None, allowed_chars=None):
     allowed_chars = settings.DEFAULT_KEY_CHARS if allowed_chars is None else allowed_chars
 
     return get_random_string(length, allowed_chars)
+
+
+def _get_translation(allowed_chars):
+    """
+    Returns translation table of random bytes to allowed chars and bytes which must be rejected. Only the bytes lower
+    than the greatest multiple of the alphabet size are used, therefore every char has the same probability.
+    """
+    alphabet = allowed_chars.encode('ascii')
+    limit = 256 - 256 % len(alphabet)
+    table = bytes(alphabet[i % len(alphabet)] if i < limit else 0 for i in range(256))
+    return table, bytes(range(limit, 256))
+
+
+def _generate_random_strings(count, length, allowed_chars):
+    if len(allowed_chars) > 256 or not allowed_chars.isascii():
+        return [get_random_string(length, allowed_chars) for _ in range(count)]
+
+    table, rejected = _get_translation(allowed_chars)
+    needed = count * length
+    chars = b''
+    while len(chars) < needed:
+        missing = needed - len(chars)
+        # one block of random bytes per batch, enlarged by the expected number of rejected bytes
+        chars += os.urandom(missing * 256 // (256 - len(rejected)) + 16).translate(table, rejected)
+    chars = chars[:needed].decode('ascii')
+    return [chars[i:i + length] for i in range(0, needed, length)]
+
+
+def batch_random_string_generator(length=None, allowed_chars=None):
+    """
+    Random string generator which reads bytes from os.urandom and maps them to allowed chars with rejection sampling.
+    Function generate_many generates count strings from one block of random bytes.
+    """
+    return batch_random_string_generator.generate_many(1, length, allowed_chars)[0]
+
+
+def _generate_many_random_strings(count, length=None, allowed_chars=None):
+    length = settings.DEFAULT_KEY_LENGTH if length is None else length
+    allowed_chars = settings.DEFAULT_KEY_CHARS if allowed_chars is None else allowed_chars
+
+    return _generate_random_strings(count, length, allowed_chars)
+
+
+batch_random_string_generator.generate_many = _generate_many_random_strings
+
+
+def generate_many(generator, count, *args, **kwargs):
+    """
+    Returns list of count keys generated with the generator generate_many function or by calling the generator count
+    times if the generator doesn't support batches.
+    """
+    if hasattr(generator, 'generate_many'):
+        return generator.generate_many(count, *args, **kwargs)
+    else:
+        return [generator(*args, **kwargs) for _ in range(count)]
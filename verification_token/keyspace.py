@@ -0,0 +1,169 @@
+import logging
+import math
+import threading
+import time
+
+from django.db import DatabaseError, connections
+from django.utils.module_loading import import_string
+
+from .config import settings
+from .generators import batch_random_string_generator, random_string_generator
+from .signals import keyspace_exhausting
+
+
+logger = logging.getLogger('verification_token')
+
+# generators whose keyspace is given by kwargs length and allowed_chars
+KEYSPACE_GENERATORS = (random_string_generator, batch_random_string_generator)
+
+# maximal length of the key field
+MAX_KEY_LENGTH = 100
+
+# unique index of the globally unique keys (constraint of VerificationToken), its size is the live token count
+KEY_UNIQUE_INDEX = 'vt_key_unique'
+
+_lock = threading.Lock()
+# the live token count is reloaded by one thread, the others use the previous count and don't wait for the query
+_reload_lock = threading.Lock()
+_state = {
+    'live_token_count': None,
+    'loaded_at': None,
+    # adapted key length (or None) per slug, key length and number of chars, checked once per count reload
+    'checked_keyspaces': {},
+}
+
+
+def reset():
+    """
+    Clears cached live token count and results of the keyspace checks.
+    """
+    with _lock:
+        _state.update(live_token_count=None, loaded_at=None, checked_keyspaces={})
+
+
+def get_expected_retries(live_token_count, keyspace_size):
+    """
+    Returns expected number of key generator retries (mean of the geometric distribution) if live_token_count keys of
+    the keyspace are used.
+    """
+    collision_probability = min(live_token_count / keyspace_size, 1)
+    return math.inf if collision_probability == 1 else collision_probability / (1 - collision_probability)
+
+
+def _is_live_token_count_stale():
+    loaded_at = _state['loaded_at']
+    return loaded_at is None or time.monotonic() - loaded_at >= settings.KEYSPACE_CHECK_INTERVAL
+
+
+def _get_estimated_live_token_count(connection):
+    """
+    Returns number of globally unique keys estimated by the planner statistics of the unique key index or None if the
+    statistics are not available. The estimate is read from the catalog without scanning the table.
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = to_regclass(%s)', [KEY_UNIQUE_INDEX])
+        elif connection.vendor == 'sqlite':
+            try:
+                # the first number of the stat column is number of the index entries
+                cursor.execute('SELECT CAST(stat AS INTEGER) FROM sqlite_stat1 WHERE idx = %s', [KEY_UNIQUE_INDEX])
+            except DatabaseError:
+                # statistics table is created by the first ANALYZE
+                return None
+        else:
+            return None
+        row = cursor.fetchone()
+    # index which was not analyzed yet has no (or a negative) estimate
+    return int(row[0]) if row and row[0] is not None and row[0] > 0 else None
+
+
+def _load_live_token_count():
+    """
+    Returns number of tokens with globally unique keys (inactive tokens which are not cleaned yet occupy the keyspace
+    too). The number is estimated by the database statistics, the tokens are counted only if the statistics are not
+    available. The count older than KEYSPACE_CHECK_INTERVAL seconds is reloaded outside of the lock by the first
+    thread, concurrent threads get the previous count (None before the first load) without waiting.
+    """
+    from .models import VerificationToken
+
+    with _lock:
+        live_token_count, is_stale = _state['live_token_count'], _is_live_token_count_stale()
+    if not is_stale or not _reload_lock.acquire(blocking=False):
+        return live_token_count
+
+    try:
+        with _lock:
+            # count could be reloaded by a concurrent thread
+            if not _is_live_token_count_stale():
+                return _state['live_token_count']
+        live_token_count = _get_estimated_live_token_count(connections[VerificationToken.objects.db])
+        if live_token_count is None:
+            live_token_count = VerificationToken.objects.filter(is_key_scoped=False).count()
+        with _lock:
+            _state.update(live_token_count=live_token_count, loaded_at=time.monotonic(), checked_keyspaces={})
+        return live_token_count
+    finally:
+        _reload_lock.release()
+
+
+def _get_adapted_length(live_token_count, length, chars_count, threshold):
+    while length < MAX_KEY_LENGTH and get_expected_retries(live_token_count, chars_count ** length) > threshold:
+        length += 1
+    return length
+
+
+def _check_keyspace(slug, length, chars_count, threshold, live_token_count):
+    from .models import VerificationToken
+
+    keyspace_size = chars_count ** length
+    expected_retries = get_expected_retries(live_token_count, keyspace_size)
+    if expected_retries <= threshold:
+        return None
+
+    adapted_length = (
+        _get_adapted_length(live_token_count, length, chars_count, threshold)
+        if settings.KEYSPACE_ADAPTIVE_LENGTH else None
+    )
+    logger.warning(
+        'Keyspace of verification token keys with slug "%s" is exhausting: %s live tokens, %s^%s keys, expected %.2f '
+        'retries of the key generator%s', slug, live_token_count, chars_count, length, expected_retries,
+        ', key length is increased to {}'.format(adapted_length) if adapted_length else ''
+    )
+    keyspace_exhausting.send(
+        sender=VerificationToken, slug=slug, live_token_count=live_token_count, keyspace_size=keyspace_size,
+        expected_retries=expected_retries, adapted_length=adapted_length
+    )
+    return adapted_length
+
+
+def check_keyspace(slug, key_generator_kwargs):
+    """
+    Compares expected number of key generator retries with setting KEYSPACE_RETRIES_THRESHOLD. If the threshold is
+    exceeded warning is logged and signal keyspace_exhausting is sent (once per KEYSPACE_CHECK_INTERVAL). With setting
+    KEYSPACE_ADAPTIVE_LENGTH returned key generator kwargs contain length which keeps expected retries under the
+    threshold. Only globally unique plain keys of the built-in generators are checked. The token count is estimated on
+    the request path once per interval and the check is skipped while another thread loads it.
+    """
+    threshold = settings.KEYSPACE_RETRIES_THRESHOLD
+    if threshold is None or settings.HASHED_KEYS or settings.has_scoped_keys(slug):
+        return key_generator_kwargs
+
+    generator = key_generator_kwargs.get('generator') or settings.DEFAULT_KEY_GENERATOR
+    if (import_string(generator) if isinstance(generator, str) else generator) not in KEYSPACE_GENERATORS:
+        return key_generator_kwargs
+
+    length = key_generator_kwargs.get('length') or settings.DEFAULT_KEY_LENGTH
+    chars_count = len(set(key_generator_kwargs.get('allowed_chars') or settings.DEFAULT_KEY_CHARS))
+    live_token_count = _load_live_token_count()
+    if live_token_count is None:
+        # count is loaded by a concurrent thread
+        return key_generator_kwargs
+
+    with _lock:
+        checked_keyspaces = _state['checked_keyspaces']
+        if (slug, length, chars_count) not in checked_keyspaces:
+            checked_keyspaces[slug, length, chars_count] = _check_keyspace(
+                slug, length, chars_count, threshold, live_token_count
+            )
+        adapted_length = checked_keyspaces[slug, length, chars_count]
+    return {**key_generator_kwargs, 'length': adapted_length} if adapted_length else key_generator_kwargs
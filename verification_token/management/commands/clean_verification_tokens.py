@@ -1,22 +1,256 @@
-from datetime import timedelta
+import signal
+import threading
+import time
 
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from django.db.models import Q
 from django.utils import timezone
 
-from verification_token.models import VerificationToken
+from verification_token import metrics
+from verification_token.config import settings
+from verification_token.models import VerificationToken, VerificationTokenGeneration
 
 
 class Command(BaseCommand):
 
-    def handle(self, **options):
-        inactive_and_expired_tokens = VerificationToken.objects.filter(
-            Q(is_active=False) | Q(expires_at__isnull=False, expires_at__lt=timezone.now())
+    help = 'Removes inactive and expired verification tokens in primary key ordered batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of tokens deleted in one transaction')
+        parser.add_argument('--sleep-between-batches', type=float, default=0,
+                            help='Seconds to sleep between batches')
+        parser.add_argument('--max-runtime', type=float, default=None,
+                            help='Stop after the given number of seconds, next run can continue with --from-pk')
+        parser.add_argument('--from-pk', type=int, default=None,
+                            help='Process only tokens with the greater primary key')
+        parser.add_argument('--dry-run', action='store_true', help='Only count tokens which would be deleted')
+        parser.add_argument('--count', action='store_true',
+                            help='Print counts of removable and remaining tokens (full table scans)')
+        parser.add_argument('--daemon', action='store_true',
+                            help='Run repeatedly, every pass processes only tokens created or expired since the '
+                                 'previous pass')
+        parser.add_argument('--interval', type=float, default=60, help='Seconds between daemon passes')
+        parser.add_argument('--full-sweep-every', type=int, default=60,
+                            help='Every N-th daemon pass processes all tokens (tokens deactivated since the previous '
+                                 'pass are removed only by full sweeps), 0 disables full sweeps')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stop_event = threading.Event()
+
+    def request_stop(self, *args):
+        self._stop_event.set()
+
+    def wait(self, seconds):
+        self._stop_event.wait(seconds)
+
+    def get_removable_token_passes(self, now):
+        """
+        Returns labels and querysets of removable tokens deleted one after another. Every queryset is filtered only by
+        one predicate, batches of inactive and expired tokens are therefore selected by the partial indexes
+        (vt_inactive_idx and vt_expires_at_idx), OR of the predicates can't use them.
+        """
+        # tokens of the previous passes are excluded, dry run therefore doesn't count them twice
+        removable_token_passes = [
+            ('inactive verification tokens', VerificationToken.objects.filter(is_active=False)),
+            ('expired verification tokens', VerificationToken.objects.expired(now).filter(is_active=True)),
+        ]
+        if settings.GENERATION_REVOCATION:
+            # tokens revoked by the generation increment are removed lazily
+            removable_token_passes.append((
+                'revoked verification tokens',
+                VerificationToken.objects.revoked().filter(is_active=True).exclude(expires_at__lt=now)
+            ))
+        return removable_token_passes
+
+    def get_removable_tokens(self, now):
+        removable_tokens = VerificationToken.objects.none()
+        for _, removable_tokens_qs in self.get_removable_token_passes(now):
+            removable_tokens |= removable_tokens_qs
+        return removable_tokens
+
+    def delete_in_batches(self, removable_tokens, batch_size, sleep_between_batches=0, max_runtime=None,
+                          from_pk=None, dry_run=False, label='verification tokens', metric_name='cleaned'):
+        """
+        Deletes tokens (or other rows of the queryset) in primary key ordered batches, every batch in its own
+        transaction. Returns number of deleted rows, primary key of the last processed row and if all rows were
+        processed.
+        """
+        start = time.monotonic()
+        deletion_count = 0
+        last_pk = from_pk
+        batch_number = 0
+        while True:
+            if self._stop_event.is_set():
+                return deletion_count, last_pk, False
+            if max_runtime is not None and time.monotonic() - start >= max_runtime:
+                self.stdout.write('Max runtime reached')
+                return deletion_count, last_pk, False
+
+            batch_qs = removable_tokens if last_pk is None else removable_tokens.filter(pk__gt=last_pk)
+            pks = list(batch_qs.order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+
+            batch_number += 1
+            last_pk = pks[-1]
+            if dry_run:
+                batch_deletion_count = len(pks)
+            else:
+                with transaction.atomic():
+                    batch_deletion_count = removable_tokens.filter(pk__in=pks).delete()[0]
+                if metric_name:
+                    metrics.incr(metric_name, batch_deletion_count)
+            deletion_count += batch_deletion_count
+            self.stdout.write('Batch {}: {} {} {} (last pk {})'.format(
+                batch_number, 'would delete' if dry_run else 'deleted', batch_deletion_count, label, last_pk
+            ))
+
+            if len(pks) < batch_size:
+                break
+            if sleep_between_batches:
+                self.wait(sleep_between_batches)
+        return deletion_count, last_pk, True
+
+    def delete_tokens(self, removable_token_passes, batch_size, sleep_between_batches=0, max_runtime=None,
+                      from_pk=None, dry_run=False):
+        """
+        Deletes tokens of every pass in batches. Returns number of deleted tokens, primary key of the last processed
+        token and if all passes were finished.
+        """
+        start = time.monotonic()
+        deletion_count = 0
+        for label, removable_tokens in removable_token_passes:
+            pass_deletion_count, last_pk, finished = self.delete_in_batches(
+                removable_tokens,
+                batch_size=batch_size,
+                sleep_between_batches=sleep_between_batches,
+                max_runtime=None if max_runtime is None else max_runtime - (time.monotonic() - start),
+                from_pk=from_pk,
+                dry_run=dry_run,
+                label=label,
+            )
+            deletion_count += pass_deletion_count
+            if not finished:
+                return deletion_count, last_pk, False
+        return deletion_count, None, True
+
+    def delete_unused_generations(self, batch_size, sleep_between_batches=0, max_runtime=None, dry_run=False):
+        """
+        Deletes generation rows created only as locks of get_active_or_create in primary key ordered batches.
+        """
+        deletion_count, _, finished = self.delete_in_batches(
+            VerificationTokenGeneration.objects.unused(),
+            batch_size=batch_size,
+            sleep_between_batches=sleep_between_batches,
+            max_runtime=max_runtime,
+            dry_run=dry_run,
+            label='unused verification token generation rows',
+            metric_name=None,
         )
+        self.stdout.write('{} {} unused verification token generation rows'.format(
+            'Would delete' if dry_run else 'Deleted', deletion_count
+        ))
+        return finished
+
+    def handle_daemon(self, batch_size, sleep_between_batches, interval, full_sweep_every, max_runtime=None,
+                      dry_run=False):
+        """
+        Deletes tokens repeatedly until SIGTERM is received. Watermark (the greatest primary key and time of the last
+        finished pass) is remembered, so the incremental pass considers only newer tokens and tokens which expired
+        since the previous pass.
+        """
+        previous_handlers = {
+            signum: signal.signal(signum, self.request_stop) for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        try:
+            self._run_daemon_passes(batch_size, sleep_between_batches, interval, full_sweep_every, max_runtime,
+                                    dry_run)
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+        self.stdout.write('Daemon stopped')
+
+    def _run_daemon_passes(self, batch_size, sleep_between_batches, interval, full_sweep_every, max_runtime,
+                           dry_run):
+        start = time.monotonic()
+        watermark_pk = watermark_time = None
+        pass_number = 0
+        while not self._stop_event.is_set():
+            pass_number += 1
+            now = timezone.now()
+            max_pk = VerificationToken.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+            full_sweep = watermark_pk is None or (full_sweep_every and pass_number % full_sweep_every == 0)
+
+            removable_token_passes = self.get_removable_token_passes(now)
+            if not full_sweep:
+                removable_token_passes = [
+                    (label, removable_tokens.filter(
+                        Q(pk__gt=watermark_pk) | Q(expires_at__gte=watermark_time, expires_at__lt=now)
+                    ))
+                    for label, removable_tokens in removable_token_passes
+                ]
+            deletion_count, _, finished = self.delete_tokens(
+                removable_token_passes,
+                batch_size=batch_size,
+                sleep_between_batches=sleep_between_batches,
+                max_runtime=None if max_runtime is None else max_runtime - (time.monotonic() - start),
+                dry_run=dry_run,
+            )
+            self.stdout.write('Pass {} ({}): {} {} inactive or expired verification tokens'.format(
+                pass_number, 'full' if full_sweep else 'incremental', 'would delete' if dry_run else 'deleted',
+                deletion_count
+            ))
+            if not finished or not self.delete_unused_generations(
+                batch_size=batch_size,
+                sleep_between_batches=sleep_between_batches,
+                max_runtime=None if max_runtime is None else max_runtime - (time.monotonic() - start),
+                dry_run=dry_run,
+            ):
+                break
+            watermark_pk, watermark_time = max_pk, now
+            self.wait(interval)
+
+    def handle(self, **options):
+        if options['daemon']:
+            self.handle_daemon(
+                batch_size=options['batch_size'],
+                sleep_between_batches=options['sleep_between_batches'],
+                interval=options['interval'],
+                full_sweep_every=options['full_sweep_every'],
+                max_runtime=options['max_runtime'],
+                dry_run=options['dry_run'],
+            )
+            return
 
-        self.stdout.write('Will delete {} inactive or expired verification tokens'.format(
-            inactive_and_expired_tokens.count())
+        now = timezone.now()
+        if options['count']:
+            self.stdout.write('Will delete {} inactive or expired verification tokens'.format(
+                self.get_removable_tokens(now).count())
+            )
+        start = time.monotonic()
+        deletion_count, last_pk, finished = self.delete_tokens(
+            self.get_removable_token_passes(now),
+            batch_size=options['batch_size'],
+            sleep_between_batches=options['sleep_between_batches'],
+            max_runtime=options['max_runtime'],
+            from_pk=options['from_pk'],
+            dry_run=options['dry_run'],
         )
-        deletion_count = inactive_and_expired_tokens.delete()
-        self.stdout.write('Deleted {} inactive or expired verification tokens'.format(deletion_count[0]))
-        self.stdout.write('{} verification tokens remain in database'.format(VerificationToken.objects.count()))
+        self.stdout.write('{} {} inactive or expired verification tokens'.format(
+            'Would delete' if options['dry_run'] else 'Deleted', deletion_count
+        ))
+        if not finished:
+            self.stdout.write('Continue with --from-pk={}'.format(last_pk))
+        else:
+            self.delete_unused_generations(
+                batch_size=options['batch_size'],
+                sleep_between_batches=options['sleep_between_batches'],
+                max_runtime=(
+                    None if options['max_runtime'] is None else options['max_runtime'] - (time.monotonic() - start)
+                ),
+                dry_run=options['dry_run'],
+            )
+        if options['count']:
+            self.stdout.write('{} verification tokens remain in database'.format(VerificationToken.objects.count()))
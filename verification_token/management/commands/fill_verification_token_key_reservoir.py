@@ -0,0 +1,75 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from verification_token import metrics
+from verification_token.config import settings
+from verification_token.models import VerificationTokenReservedKey
+
+
+class Command(BaseCommand):
+
+    help = 'Fills the reservoir of pre-generated unique verification token keys'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=None,
+                            help='Number of keys the reservoir is filled to (default VERIFICATION_TOKEN_'
+                                 'KEY_RESERVOIR_SIZE)')
+        parser.add_argument('--low-watermark', type=int, default=None,
+                            help='Reservoir is refilled only if it contains fewer keys (default VERIFICATION_TOKEN_'
+                                 'KEY_RESERVOIR_LOW_WATERMARK), one-off run without --daemon always fills it')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of keys generated in one batch')
+        parser.add_argument('--daemon', action='store_true',
+                            help='Check the reservoir depth repeatedly until SIGTERM is received')
+        parser.add_argument('--interval', type=float, default=10, help='Seconds between daemon checks')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stop_event = threading.Event()
+
+    def request_stop(self, *args):
+        self._stop_event.set()
+
+    def wait(self, seconds):
+        self._stop_event.wait(seconds)
+
+    def fill(self, size, batch_size, low_watermark=None):
+        depth = VerificationTokenReservedKey.objects.count()
+        metrics.gauge('key_reservoir.depth', depth)
+        if low_watermark is not None and depth >= low_watermark:
+            return depth
+
+        new_depth = VerificationTokenReservedKey.objects.fill(size, batch_size)
+        self.stdout.write('Reserved {} verification token keys, reservoir contains {} keys'.format(
+            max(new_depth - depth, 0), new_depth
+        ))
+        return new_depth
+
+    def handle_daemon(self, size, batch_size, low_watermark, interval):
+        previous_handlers = {
+            signum: signal.signal(signum, self.request_stop) for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        try:
+            while not self._stop_event.is_set():
+                self.fill(size, batch_size, low_watermark)
+                self.wait(interval)
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+        self.stdout.write('Daemon stopped')
+
+    def handle(self, **options):
+        size = settings.KEY_RESERVOIR_SIZE if options['size'] is None else options['size']
+        if options['daemon']:
+            self.handle_daemon(
+                size=size,
+                batch_size=options['batch_size'],
+                low_watermark=(
+                    settings.KEY_RESERVOIR_LOW_WATERMARK if options['low_watermark'] is None
+                    else options['low_watermark']
+                ),
+                interval=options['interval'],
+            )
+        else:
+            self.fill(size, options['batch_size'], options['low_watermark'])
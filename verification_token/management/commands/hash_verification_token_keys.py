@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from verification_token.config import settings
+from verification_token.models import HASHED_KEY_PREFIX, VerificationToken, get_key_digest
+
+
+class Command(BaseCommand):
+
+    help = 'Replaces plain keys of existing verification tokens with the key digest'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of tokens updated in one transaction')
+
+    def hash_batch(self, tokens):
+        """
+        Sets prefixed digest of the key to the tokens. The key is not split into the selector, the whole key is
+        therefore still required to verify the token.
+        """
+        for token in tokens:
+            token.key = HASHED_KEY_PREFIX + get_key_digest(token.key)
+        VerificationToken.objects.bulk_update(tokens, ('key',))
+        return len(tokens)
+
+    def handle(self, **options):
+        if not settings.HASHED_KEYS:
+            raise CommandError(
+                'Setting VERIFICATION_TOKEN_HASHED_KEYS must be enabled, hashed keys could not be verified otherwise'
+            )
+
+        plain_tokens = VerificationToken.objects.filter(selector__isnull=True).exclude(
+            key__startswith=HASHED_KEY_PREFIX
+        ).only('pk', 'key').order_by('pk')
+        hashed_count = 0
+        last_pk = 0
+        while True:
+            tokens = list(plain_tokens.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not tokens:
+                break
+            with transaction.atomic():
+                hashed_count += self.hash_batch(tokens)
+            last_pk = tokens[-1].pk
+        self.stdout.write('Hashed keys of {} verification tokens'.format(hashed_count))
@@ -0,0 +1,74 @@
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+from django.utils.module_loading import import_string
+
+from .config import settings
+
+
+PREFIX = 'verification_token'
+
+
+class BaseMetricsSink:
+    """
+    Receiver of verification token metrics, path to the subclass is set via setting METRICS_SINK.
+    """
+
+    def incr(self, name, value=1, tags=None):
+        raise NotImplementedError
+
+    def timing(self, name, milliseconds, tags=None):
+        raise NotImplementedError
+
+    def gauge(self, name, value, tags=None):
+        raise NotImplementedError
+
+
+@lru_cache()
+def _load_sink(path):
+    return import_string(path)()
+
+
+def get_sink():
+    path = settings.METRICS_SINK
+    return _load_sink(path) if path else None
+
+
+def is_enabled():
+    return bool(settings.METRICS_SINK)
+
+
+def _get_name(name):
+    return '{}.{}'.format(PREFIX, name)
+
+
+def incr(name, value=1, **tags):
+    sink = get_sink()
+    if sink is not None:
+        sink.incr(_get_name(name), value, tags)
+
+
+def timing(name, milliseconds, **tags):
+    sink = get_sink()
+    if sink is not None:
+        sink.timing(_get_name(name), milliseconds, tags)
+
+
+def gauge(name, value, **tags):
+    sink = get_sink()
+    if sink is not None:
+        sink.gauge(_get_name(name), value, tags)
+
+
+@contextmanager
+def timer(name, **tags):
+    sink = get_sink()
+    if sink is None:
+        yield
+    else:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            sink.timing(_get_name(name), (time.perf_counter() - start) * 1000, tags)
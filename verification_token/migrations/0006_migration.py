@@ -0,0 +1,24 @@
+from django.db import migrations, models
+import verification_token.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('verification_token', '0005_migration'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='verificationtoken',
+            index=models.Index(fields=['content_type', 'object_id', 'slug', 'is_active', 'created_at'], name='vt_active_tokens_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='verificationtoken',
+            index=verification_token.models.PartialIndex(condition=models.Q(('expires_at__isnull', False)), fields=['expires_at'], name='vt_expires_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='verificationtoken',
+            index=verification_token.models.PartialIndex(condition=models.Q(('is_active', False)), fields=['is_active'], name='vt_inactive_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('verification_token', '0006_migration'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VerificationTokenGeneration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.TextField()),
+                ('slug', models.SlugField(blank=True, default='')),
+                ('generation', models.PositiveIntegerField(default=0)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+            options={
+                'unique_together': {('content_type', 'object_id', 'slug')},
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('verification_token', '0007_migration'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VerificationTokenReservedKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=100, unique=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,63 @@
+import json
+
+from django.db import migrations, models
+
+
+BATCH_SIZE = 1000
+
+
+def _convert_in_batches(apps, from_field, to_field, convert):
+    VerificationToken = apps.get_model('verification_token', 'VerificationToken')
+    last_pk = 0
+    while True:
+        tokens = list(
+            VerificationToken.objects.filter(pk__gt=last_pk, **{'{}__isnull'.format(from_field): False})
+            .order_by('pk').only('pk', from_field)[:BATCH_SIZE]
+        )
+        if not tokens:
+            break
+        for token in tokens:
+            setattr(token, to_field, convert(getattr(token, from_field)))
+        VerificationToken.objects.bulk_update(tokens, [to_field])
+        last_pk = tokens[-1].pk
+
+
+def _decode(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        # value which was not stored with set_extra_data is kept as JSON string
+        return value
+
+
+def text_to_json(apps, schema_editor):
+    _convert_in_batches(apps, 'extra_data', 'extra_data_json', _decode)
+
+
+def json_to_text(apps, schema_editor):
+    _convert_in_batches(apps, 'extra_data_json', 'extra_data', json.dumps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('verification_token', '0008_migration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='verificationtoken',
+            name='extra_data_json',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.RunPython(text_to_json, json_to_text),
+        migrations.RemoveField(
+            model_name='verificationtoken',
+            name='extra_data',
+        ),
+        migrations.RenameField(
+            model_name='verificationtoken',
+            old_name='extra_data_json',
+            new_name='extra_data',
+        ),
+    ]
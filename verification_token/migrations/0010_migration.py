@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('verification_token', '0009_migration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='verificationtoken',
+            name='selector',
+            field=models.CharField(blank=True, max_length=12, null=True, unique=True),
+        ),
+    ]
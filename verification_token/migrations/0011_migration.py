@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('verification_token', '0010_migration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='verificationtoken',
+            name='is_key_scoped',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='verificationtoken',
+            name='key',
+            field=models.CharField(max_length=100),
+        ),
+        migrations.AddConstraint(
+            model_name='verificationtoken',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_key_scoped', False)), fields=('key',), name='vt_key_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='verificationtoken',
+            constraint=models.UniqueConstraint(condition=models.Q(('is_active', True), ('is_key_scoped', True)), fields=('content_type', 'object_id', 'slug', 'key'), name='vt_scoped_key_unique'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 18:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('verification_token', '0011_migration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='verificationtoken',
+            name='generation',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
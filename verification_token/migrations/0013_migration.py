@@ -0,0 +1,21 @@
+from django.db import migrations, models
+import verification_token.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('verification_token', '0012_migration'),
+    ]
+
+    operations = [
+        # conditional unique constraint was skipped on databases without partial indexes
+        migrations.RemoveConstraint(
+            model_name='verificationtoken',
+            name='vt_key_unique',
+        ),
+        migrations.AddConstraint(
+            model_name='verificationtoken',
+            constraint=verification_token.models.PartialUniqueConstraint(condition=models.Q(('is_key_scoped', False)), fields=('key',), name='vt_key_unique'),
+        ),
+    ]
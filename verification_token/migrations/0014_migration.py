@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('verification_token', '0013_migration'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='verificationtoken',
+            index=models.Index(fields=['key'], name='vt_key_idx'),
+        ),
+    ]
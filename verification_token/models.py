@@ -1,20 +1,239 @@
-import json
+import hashlib
+import string
+import time
+from collections import defaultdict, deque
 from datetime import timedelta
+from functools import lru_cache, partial
 
+from asgiref.sync import sync_to_async
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, models, router, transaction
+from django.db.models import Exists, F, OuterRef, Q, Subquery, Value, sql
+from django.db.models.functions import Coalesce
 from django.db.utils import IntegrityError
 from django.utils import timezone
+from django.utils.crypto import constant_time_compare
 from django.utils.module_loading import import_string
 
+from . import keyspace, metrics, validity_cache
 from .config import settings
+from .generators import batch_random_string_generator, generate_many
+from .signals import (
+    VERIFICATION_EXPIRED, VERIFICATION_HIT, VERIFICATION_MISS, token_deactivated, token_issued, token_verified
+)
 
 
-class VerificationTokenManager(models.Manager):
+_import_generator = lru_cache()(import_string)
+
+# hashed keys start with the selector which is stored in plain text
+SELECTOR_LENGTH = 12
+SELECTOR_CHARS = string.ascii_letters + string.digits
+
+# hashed scoped keys are stored without the selector as the prefixed digest
+HASHED_KEY_PREFIX = 'sha256$'
+
+
+def get_key_digest(key):
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _supports_returning(connection):
+    return connection.vendor == 'postgresql' or (
+        connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 35)
+    )
+
+
+def get_current_generation():
+    """
+    Returns expression with the current generation of the token object and slug (0 if the generation row doesn't
+    exist), the generation row is found by its unique index.
+    """
+    return Coalesce(Subquery(VerificationTokenGeneration.objects.filter(
+        content_type=OuterRef('content_type'),
+        object_id=OuterRef('object_id'),
+        slug=Coalesce(OuterRef('slug'), Value('')),
+    ).values('generation')[:1]), Value(0), output_field=models.PositiveIntegerField())
+
+
+class ReturningQuerySet(models.QuerySet):
+
+    def _supports_update_returning(self):
+        return _supports_returning(connections[self.db])
+
+    def _update_returning(self, returning_fields, **kwargs):
+        """
+        Updates rows with UPDATE ... RETURNING and returns list of tuples with values of returning_fields.
+        """
+        connection = connections[self.db]
+        query = self.query.chain(sql.UpdateQuery)
+        query.add_update_values(kwargs)
+        # annotations are not used by the update, the same as in QuerySet.update
+        query.annotations = {}
+        update_sql, params = query.get_compiler(self.db).as_sql()
+        returning_sql = ', '.join(
+            connection.ops.quote_name(self.model._meta.get_field(field_name).column) for field_name in returning_fields
+        )
+        with connection.cursor() as cursor:
+            cursor.execute('{} RETURNING {}'.format(update_sql, returning_sql), params)
+            return cursor.fetchall()
+
+
+class VerificationTokenQuerySet(ReturningQuerySet):
+
+    def _get_not_revoked_q(self):
+        return Q(generation=get_current_generation()) if settings.GENERATION_REVOCATION else Q()
+
+    def annotate_current_generation(self):
+        """
+        Annotates tokens with current_generation used by VerificationToken.is_revoked if setting GENERATION_REVOCATION
+        is enabled, the revocation check of the loaded tokens therefore doesn't run a query per token.
+        """
+        return self.annotate(current_generation=get_current_generation()) if settings.GENERATION_REVOCATION else self
+
+    def _get_valid_q(self, now=None):
+        """
+        Returns Q object of valid tokens, SQL equivalent of VerificationToken.is_valid shared by all validity filters.
+        """
+        now = timezone.now() if now is None else now
+        return Q(is_active=True) & (Q(expires_at__isnull=True) | Q(expires_at__gte=now)) & self._get_not_revoked_q()
+
+    def active(self):
+        """
+        Returns active tokens which were not revoked by the generation increment, expired tokens are included.
+        """
+        return self.annotate_current_generation().filter(Q(is_active=True) & self._get_not_revoked_q())
+
+    def valid(self, now=None):
+        """
+        Returns active tokens which are not expired at now (default is the current time).
+        """
+        return self.annotate_current_generation().filter(self._get_valid_q(now))
+
+    def expired(self, now=None):
+        """
+        Returns tokens which expired before now (default is the current time), inactive tokens are included.
+        """
+        return self.filter(expires_at__isnull=False, expires_at__lt=timezone.now() if now is None else now)
+
+    def _for_content_type(self, content_type, obj_or_class):
+        qs = self.filter(content_type=content_type)
+        return qs.filter(object_id=obj_or_class.pk) if isinstance(obj_or_class, models.Model) else qs
+
+    def for_object(self, obj_or_class):
+        """
+        Returns tokens of the object or of all objects of the model class.
+        """
+        return self._for_content_type(ContentType.objects.get_for_model(obj_or_class), obj_or_class)
+
+    def for_slug(self, slug=None):
+        return self.filter(slug=slug)
+
+    def annotate_is_valid(self, now=None):
+        """
+        Annotates tokens with is_currently_valid computed in SQL with the same predicate as valid().
+        """
+        return self.annotate(is_currently_valid=models.Case(
+            models.When(self._get_valid_q(now), then=Value(True)),
+            default=Value(False),
+            output_field=models.BooleanField(),
+        ))
+
+    def not_revoked(self):
+        """
+        Excludes tokens revoked by the generation increment if setting GENERATION_REVOCATION is enabled.
+        """
+        return self.annotate_current_generation().filter(self._get_not_revoked_q())
+
+    def revoked(self):
+        """
+        Returns tokens issued under a previous generation of their object and slug.
+        """
+        return self.filter(generation__lt=get_current_generation())
+
+    def prefetch_content_objects(self):
+        """
+        Loads content objects of the tokens with one query per content type.
+        """
+        return self.prefetch_related('content_object')
+
+
+class VerificationTokenManager(models.Manager.from_queryset(VerificationTokenQuerySet)):
+
+    def _issued(self, tokens, slug):
+        metrics.incr('issued', len(tokens), slug=slug)
+        token_issued.send(sender=self.model, tokens=tokens)
+
+    def _deactivated(self, obj, slug, key, count):
+        if count is None:
+            metrics.incr('revoked', slug=slug)
+        else:
+            metrics.incr('deactivated', count, slug=slug)
+        token_deactivated.send(sender=self.model, obj=obj, slug=slug, key=key, count=count)
+
+    def _verified(self, obj, slug, key, result, start):
+        metrics.incr('verified', result=result, slug=slug)
+        metrics.timing('verify', (time.perf_counter() - start) * 1000, slug=slug)
+        token_verified.send(sender=self.model, obj=obj, slug=slug, key=key, result=result)
+
+    def _is_verification_instrumented(self):
+        return metrics.is_enabled() or token_verified.has_listeners(self.model)
+
+    def _get_verification_result(self, expires_at_rows):
+        if not expires_at_rows:
+            return VERIFICATION_MISS
+        expires_at = expires_at_rows[0][0]
+        return VERIFICATION_EXPIRED if expires_at is not None and expires_at < timezone.now() else VERIFICATION_HIT
+
+    def _get_cache_lookup(self, content_type, obj_or_class):
+        return content_type.pk, (
+            str(obj_or_class.pk) if isinstance(obj_or_class, models.Model) else validity_cache.CLASS_OBJECT_ID
+        )
+
+    def _uses_validity_cache(self, obj, key):
+        # results of the model class tokens can't be invalidated by deactivation of a single object tokens
+        return validity_cache.is_enabled() and bool(key) and isinstance(obj, models.Model)
+
+    def _on_commit(self, func, *args):
+        """
+        Runs the validity cache update after the transaction is committed, concurrent verification therefore can't
+        cache the result of the uncommitted (or rolled back) change. Without transaction it is run immediately.
+        """
+        transaction.on_commit(partial(func, *args), using=self.db)
+
+    def _invalidate_cached(self, obj_or_class, slug):
+        if validity_cache.is_enabled():
+            content_type_id, object_id = self._get_cache_lookup(
+                ContentType.objects.get_for_model(obj_or_class), obj_or_class
+            )
+            self._on_commit(validity_cache.invalidate, content_type_id, [object_id], slug)
+
+    async def _ainvalidate_cached(self, obj_or_class, slug):
+        if validity_cache.is_enabled():
+            content_type_id, object_id = self._get_cache_lookup(
+                await self._aget_content_type(obj_or_class), obj_or_class
+            )
+            # async ORM queries run in autocommit mode, the change is already committed
+            await validity_cache.ainvalidate(content_type_id, [object_id], slug)
+
+    def _uses_generation_revocation(self, obj, key):
+        # single token is always deactivated by the update of its row
+        return settings.GENERATION_REVOCATION and key is None and isinstance(obj, models.Model)
 
     def deactivate(self, obj, slug=None, key=None):
-        self.filter_active_tokens(obj, slug, key).update(is_active=False)
+        """
+        Deactivates tokens of the object and returns their count. With setting GENERATION_REVOCATION all tokens of the
+        object and slug are revoked by incrementing their generation (single row update) and None is returned.
+        """
+        if self._uses_generation_revocation(obj, key):
+            VerificationTokenGeneration.objects.db_manager(self.db).increment(obj, slug)
+            count = None
+        else:
+            count = self.filter_active_tokens(obj, slug, key).update(is_active=False)
+        self._invalidate_cached(obj, slug)
+        self._deactivated(obj, slug, key, count)
+        return count
 
     def deactivate_and_create(self, obj, slug=None, extra_data=None, deactivate_old_tokens=True,
                               key_generator_kwargs=None, **kwargs):
@@ -23,48 +242,432 @@ class VerificationTokenManager(models.Manager):
 
         return self._create(obj, slug=slug, extra_data=extra_data, key_generator_kwargs=key_generator_kwargs, **kwargs)
 
+    def _get_last_valid_token_queryset(self, qs):
+        # extra data are loaded only when they are accessed
+        return qs.only(*(
+            field.attname for field in self.model._meta.concrete_fields if field.name != 'extra_data'
+        )).order_by('created_at')
+
+    def _get_last_valid_token(self, qs):
+        return self._get_last_valid_token_queryset(qs).last()
+
     def get_active_or_create(self, obj, slug=None, extra_data=None, key=None, key_generator_kwargs=None, **kwargs):
-        token = self.filter_active_tokens(obj, slug, key).order_by('created_at').last()
+        """
+        Returns the last valid token or creates a new one. Creation is serialized by the lock of the object and slug
+        generation row, therefore concurrent callers get the same token.
+        """
+        token = self._get_last_valid_token(self._filter_valid_tokens(obj, slug, key))
+        return token or self._lock_and_get_active_or_create(
+            obj, slug=slug, extra_data=extra_data, key=key, key_generator_kwargs=key_generator_kwargs, **kwargs
+        )
 
-        if token and token.is_valid:
-            return token
-        else:
-            return self._create(obj, slug=slug, extra_data=extra_data, key_generator_kwargs=key_generator_kwargs,
-                                **kwargs
+    def _lock_and_get_active_or_create(self, obj, slug=None, extra_data=None, key=None, key_generator_kwargs=None,
+                                       **kwargs):
+        with transaction.atomic(using=self.db):
+            is_lock_created = VerificationTokenGeneration.objects.db_manager(self.db).lock(obj, slug)
+            # token could be created by a concurrent request before the existing lock was acquired
+            token = None if is_lock_created else self._get_last_valid_token(self._filter_valid_tokens(obj, slug, key))
+            return token or self._create(
+                obj, slug=slug, extra_data=extra_data, key_generator_kwargs=key_generator_kwargs, **kwargs
             )
 
-    def _create(self, obj, slug=None, extra_data=None, key_generator_kwargs=None, **kwargs):
-        expiration_in_minutes = kwargs.pop('expiration_in_minutes', settings.DEFAULT_EXPIRATION)
-        key_generator_kwargs = {} if key_generator_kwargs is None else key_generator_kwargs
+    def bulk_deactivate_and_create(self, objs, slug=None, extra_data=None, deactivate_old_tokens=True,
+                                   key_generator_kwargs=None, batch_size=500, return_tokens=True, **kwargs):
+        """
+        Deactivates old tokens and creates a new one for every object. Objects (list or queryset) are processed in
+        batches of batch_size, querysets are iterated without caching the instances. Every batch is processed in its
+        own transaction. Returns list of created tokens or only their count if return_tokens is False (created tokens
+        are not kept in memory).
+        """
+        tokens = []
+        count = 0
+        for batch in self._iter_batches(objs, batch_size):
+            with transaction.atomic(using=self.db):
+                batch_tokens = self._bulk_create(
+                    batch, slug=slug, extra_data=extra_data, deactivate_old_tokens=deactivate_old_tokens,
+                    key_generator_kwargs=key_generator_kwargs, **kwargs
+                )
+            count += len(batch_tokens)
+            if return_tokens:
+                tokens += batch_tokens
+        return tokens if return_tokens else count
+
+    def _iter_batches(self, objs, batch_size):
+        if isinstance(objs, models.QuerySet):
+            objs = objs.iterator(chunk_size=batch_size)
+
+        batch = []
+        for obj in objs:
+            batch.append(obj)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _bulk_create(self, objs, slug=None, extra_data=None, deactivate_old_tokens=True, key_generator_kwargs=None,
+                     **kwargs):
+        expiration_in_minutes = kwargs.pop('expiration_in_minutes', settings.get_expiration(slug))
+        key_generator_kwargs = keyspace.check_keyspace(
+            slug, settings.get_key_generator_kwargs(slug, key_generator_kwargs)
+        )
+
+        object_ids_by_content_type = defaultdict(list)
+        for obj in objs:
+            object_ids_by_content_type[ContentType.objects.get_for_model(obj.__class__)].append(str(obj.pk))
+
+        if deactivate_old_tokens:
+            for content_type, object_ids in object_ids_by_content_type.items():
+                self.filter(
+                    is_active=True, slug=slug, content_type=content_type, object_id__in=object_ids
+                ).update(is_active=False)
+
+        generations = {}
+        if settings.GENERATION_REVOCATION:
+            for content_type, object_ids in object_ids_by_content_type.items():
+                generations.update({
+                    (content_type, object_id): generation
+                    for object_id, generation in VerificationTokenGeneration.objects.filter(
+                        content_type=content_type, object_id__in=object_ids, slug=slug or ''
+                    ).values_list('object_id', 'generation')
+                })
+
+        expires_at = (timezone.now() + timedelta(minutes=expiration_in_minutes)) if expiration_in_minutes else None
+        is_key_scoped = self._has_scoped_keys(slug)
+        # scope of the whole batch is used, therefore keys are checked against tokens of all objects with the slug
+        all_object_ids = [object_id for object_ids in object_ids_by_content_type.values() for object_id in object_ids]
+        keys = self.model._generate_keys(
+            len(objs), {'slug': slug, 'object_id__in': all_object_ids} if is_key_scoped else None, slug,
+            **key_generator_kwargs
+        )
+        tokens = []
+        for content_type, object_ids in object_ids_by_content_type.items():
+            for object_id in object_ids:
+                token = self.model(
+                    content_type=content_type,
+                    object_id=object_id,
+                    slug=slug,
+                    expires_at=expires_at,
+                    is_key_scoped=is_key_scoped,
+                    generation=generations.get((content_type, object_id), 0),
+                )
+                token.set_key(keys.pop())
+                if extra_data:
+                    token.set_extra_data(extra_data)
+                tokens.append(token)
+        tokens = self.bulk_create(tokens)
+        if validity_cache.is_enabled():
+            # negative results of the new keys are invalidated too
+            for content_type, object_ids in object_ids_by_content_type.items():
+                self._on_commit(validity_cache.invalidate, content_type.pk, object_ids, slug)
+        self._issued(tokens, slug)
+        return tokens
+
+    def _build_token(self, obj, content_type, slug=None, extra_data=None, **kwargs):
+        expiration_in_minutes = kwargs.pop('expiration_in_minutes', settings.get_expiration(slug))
 
         token = self.model(
-            content_type=ContentType.objects.get_for_model(obj.__class__),
+            content_type=content_type,
             object_id=obj.pk,
             slug=slug,
             expires_at=(timezone.now() + timedelta(minutes=expiration_in_minutes)) if expiration_in_minutes else None,
-            key=self.model.generate_key(**key_generator_kwargs),
+            is_key_scoped=self._has_scoped_keys(slug),
         )
         if extra_data:
             token.set_extra_data(extra_data)
+        return token
 
-        token.save()
+    def _has_scoped_keys(self, slug):
+        if not settings.has_scoped_keys(slug):
+            return False
+        if not connections[self.db].features.supports_partial_indexes:
+            # key is unique across all tokens without the partial unique index
+            raise ImproperlyConfigured('Scoped keys require database with partial indexes support')
+        return True
+
+    def _uses_key_reservoir(self, slug, key_generator_kwargs):
+        # reserved keys are generated with the default generator settings only, they are globally unique and not hashed
+        return (
+            settings.KEY_RESERVOIR and not settings.HASHED_KEYS and not settings.has_scoped_keys(slug)
+            and not key_generator_kwargs
+        )
+
+    def _create(self, obj, slug=None, extra_data=None, key_generator_kwargs=None, **kwargs):
+        key_generator_kwargs = keyspace.check_keyspace(
+            slug, settings.get_key_generator_kwargs(slug, key_generator_kwargs)
+        )
+        token = self._build_token(
+            obj, ContentType.objects.get_for_model(obj.__class__), slug=slug, extra_data=extra_data, **kwargs
+        )
+        if settings.GENERATION_REVOCATION:
+            token.generation = VerificationTokenGeneration.objects.db_manager(self.db).get_generation(obj, slug)
+
+        reserved_key = (
+            VerificationTokenReservedKey.objects.pop() if self._uses_key_reservoir(slug, key_generator_kwargs) else None
+        )
+        if settings.OPTIMISTIC_KEY_GENERATION or reserved_key:
+            token._insert_with_generated_key(key_generator_kwargs, first_key=reserved_key)
+        else:
+            token.set_key(self.model._generate_key(token.get_key_scope(), slug, **key_generator_kwargs))
+            token.save()
+        if validity_cache.is_enabled():
+            self._on_commit(validity_cache.write_through, token)
+        self._issued([token], slug)
         return token
 
     def exists_valid(self, obj, key, slug=None):
-        for token in self.filter_active_tokens(obj, slug):
-            if token.check_key(key):
-                return True
-        return False
+        if self._uses_validity_cache(obj, key):
+            return self._exists_valid_cached(obj, key, slug)
+        if not self._is_verification_instrumented():
+            return bool(key) and self._filter_valid_tokens(obj, slug, key).exists()
 
-    def filter_active_tokens(self, obj_or_class, slug=None, key=None):
-        qs = self.filter(
-            is_active=True,
-            slug=slug,
-            content_type=ContentType.objects.get_for_model(obj_or_class),
+        # expiration is fetched (in the same single query) to distinguish expired and missing tokens
+        start = time.perf_counter()
+        expires_at_rows = list(
+            self.filter_active_tokens(obj, slug, key).order_by().values_list('expires_at')[:1]
+        ) if key else []
+        result = self._get_verification_result(expires_at_rows)
+        self._verified(obj, slug, key, result, start)
+        return result == VERIFICATION_HIT
+
+    def _exists_valid_cached(self, obj, key, slug):
+        """
+        Verification result is taken from the validity cache, on cache miss it is loaded with one query and stored.
+        """
+        start = time.perf_counter()
+        lookup = self._get_cache_lookup(ContentType.objects.get_for_model(obj), obj)
+        result, version = validity_cache.get(*lookup, slug, key)
+        if result is None:
+            expires_at_rows = list(self.filter_active_tokens(obj, slug, key).order_by().values_list('expires_at')[:1])
+            result = self._get_verification_result(expires_at_rows)
+            validity_cache.store(
+                *lookup, slug, key, version, result, expires_at_rows[0][0] if expires_at_rows else None
+            )
+        self._verified(obj, slug, key, result, start)
+        return result == VERIFICATION_HIT
+
+    def consume(self, obj, key, slug=None, return_extra_data=False):
+        """
+        Deactivates valid token with the key using one conditional UPDATE, so the token can be consumed only once.
+        Returns True if the token was consumed. With return_extra_data tuple (consumed, extra_data) is returned,
+        extra data are obtained in the same query via UPDATE ... RETURNING where the database supports it.
+        """
+        start = time.perf_counter()
+        qs = self._filter_valid_tokens(obj, slug, key) if key else self.none()
+        if not return_extra_data:
+            consumed = qs.update(is_active=False) > 0
+            self._consumed(obj, slug, key, consumed, start)
+            return consumed
+
+        if qs._supports_update_returning():
+            rows = qs._update_returning(('extra_data',), is_active=False)
+            # raw cursor returns the database representation of the JSON field
+            extra_data = self.model._meta.get_field('extra_data').from_db_value(
+                rows[0][0], None, connections[qs.db]
+            ) if rows else None
+            consumed = bool(rows)
+        else:
+            with transaction.atomic(using=qs.db):
+                token = qs.select_for_update().only('pk', 'extra_data').first()
+                consumed = token is not None and self.filter(pk=token.pk).update(is_active=False) > 0
+                extra_data = token.extra_data if token else None
+        self._consumed(obj, slug, key, consumed, start)
+        return consumed, extra_data
+
+    def _consumed(self, obj, slug, key, consumed, start):
+        if consumed:
+            self._invalidate_cached(obj, slug)
+        self._verified(obj, slug, key, VERIFICATION_HIT if consumed else VERIFICATION_MISS, start)
+
+    def verify_key(self, key, slug=None, consume=False):
+        """
+        Returns valid token with the key and slug with loaded content_object or None. Token is found with one query
+        and the object is loaded with another one (content type is taken from the cache). With consume the token is
+        deactivated with a conditional UPDATE, so only one of concurrent callers gets the token.
+        """
+        if settings.has_scoped_keys(slug):
+            raise ValueError('Tokens with scoped keys must be verified with the object')
+
+        start = time.perf_counter()
+        # current generation is loaded in the same query for the token is_revoked check
+        qs = self.for_slug(slug).filter(
+            self.model.get_key_lookup(key, compare_digest=False), is_active=True, is_key_scoped=False
+        ).annotate_current_generation()
+        token = qs.first() if key else None
+        if token is None or not token.matches_key(key):
+            result = VERIFICATION_MISS
+        elif not token.is_valid:
+            result = VERIFICATION_EXPIRED
+        elif consume and not self.filter(pk=token.pk).valid().update(is_active=False):
+            # token was consumed by a concurrent request
+            result = VERIFICATION_MISS
+        else:
+            result = VERIFICATION_HIT
+            token.is_active = not consume
+            if consume and validity_cache.is_enabled():
+                self._on_commit(validity_cache.invalidate, token.content_type_id, [token.object_id], slug)
+
+        # accessing content_object loads and caches the object
+        obj = token.content_object if result == VERIFICATION_HIT else None
+        self._verified(obj, slug, key, result, start)
+        return token if result == VERIFICATION_HIT else None
+
+    def filter_active_tokens(self, obj_or_class, slug=None, key=None, **extra_data_lookups):
+        """
+        Returns active tokens of the object or model class. Extra data lookups (e.g. extra_data__email='...') are
+        applied in the database.
+        """
+        return self._filter_tokens(
+            ContentType.objects.get_for_model(obj_or_class), obj_or_class, slug, key, **extra_data_lookups
+        ).active()
+
+    def _filter_valid_tokens(self, obj, slug=None, key=None):
+        # valid() contains the active() predicate, therefore the predicates are not duplicated
+        return self._filter_tokens(ContentType.objects.get_for_model(obj), obj, slug, key).valid()
+
+    def _filter_tokens(self, content_type, obj_or_class, slug=None, key=None, **extra_data_lookups):
+        invalid_lookups = [lookup for lookup in extra_data_lookups if lookup.split('__')[0] != 'extra_data']
+        if invalid_lookups:
+            raise TypeError('Invalid extra data lookups: {}'.format(', '.join(invalid_lookups)))
+
+        qs = self.get_queryset()._for_content_type(content_type, obj_or_class).for_slug(slug).filter(
+            **extra_data_lookups
+        )
+        return qs.filter(self.model.get_key_lookup(key)) if key else qs
+
+    async def _aget_content_type(self, obj_or_class):
+        model = obj_or_class if isinstance(obj_or_class, type) else obj_or_class.__class__
+        try:
+            # content types are cached in the process, the cached one is returned without the thread switch
+            return ContentType.objects._get_from_cache(ContentType.objects._get_opts(model, True))
+        except KeyError:
+            # ContentType manager has no async API
+            return await sync_to_async(ContentType.objects.get_for_model)(model)
+
+    async def afilter_active_tokens(self, obj_or_class, slug=None, key=None, **extra_data_lookups):
+        return self._filter_tokens(
+            await self._aget_content_type(obj_or_class), obj_or_class, slug, key, **extra_data_lookups
+        ).active()
+
+    async def _afilter_valid_tokens(self, obj, slug=None, key=None):
+        return self._filter_tokens(await self._aget_content_type(obj), obj, slug, key).valid()
+
+    async def adeactivate(self, obj, slug=None, key=None):
+        if self._uses_generation_revocation(obj, key):
+            # increment requires savepoints which are not available in the async ORM
+            await sync_to_async(VerificationTokenGeneration.objects.db_manager(self.db).increment)(obj, slug)
+            count = None
+        else:
+            count = await (await self.afilter_active_tokens(obj, slug, key)).aupdate(is_active=False)
+        await self._ainvalidate_cached(obj, slug)
+        self._deactivated(obj, slug, key, count)
+        return count
+
+    async def adeactivate_and_create(self, obj, slug=None, extra_data=None, deactivate_old_tokens=True,
+                                     key_generator_kwargs=None, **kwargs):
+        if deactivate_old_tokens:
+            await self.adeactivate(obj, slug)
+
+        return await self._acreate(
+            obj, slug=slug, extra_data=extra_data, key_generator_kwargs=key_generator_kwargs, **kwargs
+        )
+
+    async def aget_active_or_create(self, obj, slug=None, extra_data=None, key=None, key_generator_kwargs=None,
+                                    **kwargs):
+        token = await self._get_last_valid_token_queryset(await self._afilter_valid_tokens(obj, slug, key)).alast()
+        # transaction with the lock is not available in the async ORM
+        return token or await sync_to_async(self._lock_and_get_active_or_create)(
+            obj, slug=slug, extra_data=extra_data, key=key, key_generator_kwargs=key_generator_kwargs, **kwargs
         )
-        if isinstance(obj_or_class, models.Model):
-            qs = qs.filter(object_id=obj_or_class.pk)
-        return qs.filter(key=key) if key else qs
+
+    async def _acreate(self, obj, slug=None, extra_data=None, key_generator_kwargs=None, **kwargs):
+        key_generator_kwargs = keyspace.check_keyspace(
+            slug, settings.get_key_generator_kwargs(slug, key_generator_kwargs)
+        )
+        token = self._build_token(
+            obj, await self._aget_content_type(obj), slug=slug, extra_data=extra_data, **kwargs
+        )
+        if settings.GENERATION_REVOCATION:
+            token.generation = await sync_to_async(
+                VerificationTokenGeneration.objects.db_manager(self.db).get_generation
+            )(obj, slug)
+
+        reserved_key = (
+            await sync_to_async(VerificationTokenReservedKey.objects.pop)()
+            if self._uses_key_reservoir(slug, key_generator_kwargs) else None
+        )
+        if settings.OPTIMISTIC_KEY_GENERATION or reserved_key:
+            # retry of the insert requires savepoints which are not available in the async ORM
+            await sync_to_async(token._insert_with_generated_key)(key_generator_kwargs, first_key=reserved_key)
+        else:
+            token.set_key(await self.model._agenerate_key(token.get_key_scope(), slug, **key_generator_kwargs))
+            await token.asave()
+        if validity_cache.is_enabled():
+            await validity_cache.awrite_through(token)
+        self._issued([token], slug)
+        return token
+
+    async def aexists_valid(self, obj, key, slug=None):
+        if self._uses_validity_cache(obj, key):
+            return await self._aexists_valid_cached(obj, key, slug)
+        if not self._is_verification_instrumented():
+            return bool(key) and await (await self._afilter_valid_tokens(obj, slug, key)).aexists()
+
+        start = time.perf_counter()
+        qs = await self.afilter_active_tokens(obj, slug, key)
+        expires_at_rows = [row async for row in qs.order_by().values_list('expires_at')[:1]] if key else []
+        result = self._get_verification_result(expires_at_rows)
+        self._verified(obj, slug, key, result, start)
+        return result == VERIFICATION_HIT
+
+    async def _aexists_valid_cached(self, obj, key, slug):
+        start = time.perf_counter()
+        lookup = self._get_cache_lookup(await self._aget_content_type(obj), obj)
+        result, version = await validity_cache.aget(*lookup, slug, key)
+        if result is None:
+            qs = await self.afilter_active_tokens(obj, slug, key)
+            expires_at_rows = [row async for row in qs.order_by().values_list('expires_at')[:1]]
+            result = self._get_verification_result(expires_at_rows)
+            await validity_cache.astore(
+                *lookup, slug, key, version, result, expires_at_rows[0][0] if expires_at_rows else None
+            )
+        self._verified(obj, slug, key, result, start)
+        return result == VERIFICATION_HIT
+
+    async def aconsume(self, obj, key, slug=None, return_extra_data=False):
+        if return_extra_data:
+            return await sync_to_async(self.consume)(obj, key, slug=slug, return_extra_data=True)
+
+        start = time.perf_counter()
+        qs = (await self._afilter_valid_tokens(obj, slug, key)) if key else self.none()
+        consumed = await qs.aupdate(is_active=False) > 0
+        if consumed:
+            await self._ainvalidate_cached(obj, slug)
+        self._verified(obj, slug, key, VERIFICATION_HIT if consumed else VERIFICATION_MISS, start)
+        return consumed
+
+
+class PartialIndex(models.Index):
+    """
+    Partial index which is created as a full index on backends without partial indexes support.
+    """
+
+    def _get_condition_sql(self, model, schema_editor):
+        if not schema_editor.connection.features.supports_partial_indexes:
+            return None
+        return super()._get_condition_sql(model, schema_editor)
+
+
+class PartialUniqueConstraint(models.UniqueConstraint):
+    """
+    Conditional unique constraint which is created as a full unique index on backends without partial indexes support
+    (Django skips conditional unique constraints there), uniqueness is therefore never silently lost.
+    """
+
+    def _get_condition_sql(self, model, schema_editor):
+        if not schema_editor.connection.features.supports_partial_indexes:
+            return None
+        return super()._get_condition_sql(model, schema_editor)
 
 
 class VerificationToken(models.Model):
@@ -76,56 +679,490 @@ class VerificationToken(models.Model):
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
     object_id = models.TextField(db_index=True)
     content_object = GenericForeignKey('content_type', 'object_id')
-    key = models.CharField(null=False, blank=False, max_length=100, unique=True)
+    key = models.CharField(null=False, blank=False, max_length=100)
+    selector = models.CharField(null=True, blank=True, max_length=SELECTOR_LENGTH, unique=True)
     expires_at = models.DateTimeField(null=True, blank=True, default=None)
     slug = models.SlugField(null=True, blank=True)
     is_active = models.BooleanField(null=False, blank=False, default=True)
-    extra_data = models.TextField(null=True, blank=True)
+    extra_data = models.JSONField(null=True, blank=True)
+    is_key_scoped = models.BooleanField(null=False, blank=False, default=False)
+    generation = models.PositiveIntegerField(null=False, blank=False, default=0)
 
     objects = VerificationTokenManager()
 
     @classmethod
-    def generate_key(cls, generator=None, *args, **kwargs):
+    def get_key_generator(cls, generator=None):
+        generator = settings.DEFAULT_KEY_GENERATOR if generator is None else generator
+        return _import_generator(generator) if isinstance(generator, str) else generator
+
+    @classmethod
+    def get_key_lookup(cls, key, compare_digest=True):
         """
-        Generate random unique token key.
+        Returns Q object which finds token with the key. Hashed token is found by the selector (and the digest),
+        hashed scoped token (always filtered with its object) by the digest and tokens without selector (created
+        before the keys were hashed) by the plain key.
         """
-        generator = settings.DEFAULT_KEY_GENERATOR if generator is None else generator
-        generator_func = import_string(generator) if isinstance(generator, str) else generator
+        if not key:
+            return Q(pk__in=())
+
+        # digest of the hashed key is never accepted as a plain key
+        is_digest = key.startswith(HASHED_KEY_PREFIX)
+        if not settings.HASHED_KEYS:
+            # simple equality is resolved by the key index
+            return Q(pk__in=()) if is_digest else Q(key=key)
+
+        plain_lookup = Q(pk__in=()) if is_digest else Q(key=key, selector__isnull=True)
+
+        hashed_lookup = Q(selector=key[:SELECTOR_LENGTH], key=get_key_digest(key)) if compare_digest else Q(
+            selector=key[:SELECTOR_LENGTH]
+        )
+        return hashed_lookup | Q(key=cls._get_scoped_key_digest(key), selector__isnull=True) | plain_lookup
+
+    @classmethod
+    def _get_scoped_key_digest(cls, key):
+        return HASHED_KEY_PREFIX + get_key_digest(key)
 
+    @classmethod
+    def _uses_selector(cls, scope):
+        # scoped keys (e.g. short SMS codes) are hashed without the selector, their length and chars are kept
+        return settings.HASHED_KEYS and scope is None
+
+    @classmethod
+    def _get_unique_value(cls, key, scope=None):
+        if cls._uses_selector(scope):
+            return key[:SELECTOR_LENGTH]
+        return cls._get_scoped_key_digest(key) if settings.HASHED_KEYS else key
+
+    @classmethod
+    def _filter_colliding_tokens(cls, keys, scope=None):
+        """
+        Returns tokens which collide with the keys. Selector of the hashed key is unique globally, scoped key only
+        among active tokens in the scope (lookup of the object and slug).
+        """
+        values = [cls._get_unique_value(key, scope) for key in keys]
+        if cls._uses_selector(scope):
+            return cls.objects.filter(selector__in=values)
+        elif scope is not None:
+            return cls.objects.filter(key__in=values, is_key_scoped=True, is_active=True, **scope)
+        else:
+            return cls.objects.filter(key__in=values, is_key_scoped=False)
+
+    @classmethod
+    def _generate_raw_key(cls, generator_func, scope, *args, **kwargs):
         key = generator_func(*args, **kwargs)
+        # selector is generated separately, therefore the key length and chars are kept
+        return (
+            batch_random_string_generator(SELECTOR_LENGTH, SELECTOR_CHARS) + key if cls._uses_selector(scope) else key
+        )
+
+    @classmethod
+    def generate_key(cls, generator=None, *args, **kwargs):
+        """
+        Generate random unique token key. Hashed key is prefixed with the selector which must be unique.
+        """
+        return cls._generate_key(None, None, generator, *args, **kwargs)
+
+    @classmethod
+    def _collided(cls, count, slug, generator_func):
+        metrics.incr('key_collisions', count, slug=slug, generator=getattr(
+            generator_func, '__qualname__', generator_func.__class__.__qualname__
+        ))
+
+    @classmethod
+    def _generate_key(cls, scope, slug=None, generator=None, *args, **kwargs):
+        generator_func = cls.get_key_generator(generator)
+
+        key = cls._generate_raw_key(generator_func, scope, *args, **kwargs)
         try_generator_iterations = 1
-        while cls.objects.filter(key=key).exists():
+        while cls._filter_colliding_tokens([key], scope).exists():
+            cls._collided(1, slug, generator_func)
             if try_generator_iterations >= settings.MAX_RANDOM_KEY_ITERATIONS:
                 raise IntegrityError('Could not produce unique key for verification token')
             try_generator_iterations += 1
-            key = generator_func(*args, **kwargs)
+            key = cls._generate_raw_key(generator_func, scope, *args, **kwargs)
         return key
 
+    @classmethod
+    async def agenerate_key(cls, generator=None, *args, **kwargs):
+        """
+        Async variant of generate_key.
+        """
+        return await cls._agenerate_key(None, None, generator, *args, **kwargs)
+
+    @classmethod
+    async def _agenerate_key(cls, scope, slug=None, generator=None, *args, **kwargs):
+        generator_func = cls.get_key_generator(generator)
+
+        key = cls._generate_raw_key(generator_func, scope, *args, **kwargs)
+        try_generator_iterations = 1
+        while await cls._filter_colliding_tokens([key], scope).aexists():
+            cls._collided(1, slug, generator_func)
+            if try_generator_iterations >= settings.MAX_RANDOM_KEY_ITERATIONS:
+                raise IntegrityError('Could not produce unique key for verification token')
+            try_generator_iterations += 1
+            key = cls._generate_raw_key(generator_func, scope, *args, **kwargs)
+        return key
+
+    @classmethod
+    def generate_keys(cls, count, generator=None, *args, **kwargs):
+        """
+        Generate count random unique token keys. Keys are generated in batches if the generator supports generate_many.
+        Uniqueness is checked with one query per generator iteration and only the colliding keys are generated again.
+        """
+        return cls._generate_keys(count, None, None, generator, *args, **kwargs)
+
+    @classmethod
+    def _generate_keys(cls, count, scope, slug=None, generator=None, *args, **kwargs):
+        generator_func = cls.get_key_generator(generator)
+
+        keys = set()
+        try_generator_iterations = 0
+        while len(keys) < count:
+            if try_generator_iterations >= settings.MAX_RANDOM_KEY_ITERATIONS:
+                raise IntegrityError('Could not produce unique keys for verification tokens')
+            try_generator_iterations += 1
+
+            # keys colliding inside the batch are generated again in the next iteration too
+            candidates = set(generate_many(generator_func, count - len(keys), *args, **kwargs))
+            if cls._uses_selector(scope):
+                candidates = {
+                    selector + key for selector, key in zip(
+                        batch_random_string_generator.generate_many(len(candidates), SELECTOR_LENGTH, SELECTOR_CHARS),
+                        candidates
+                    )
+                }
+            candidates -= keys
+            colliding_values = set(cls._filter_colliding_tokens(candidates, scope).values_list(
+                'selector' if cls._uses_selector(scope) else 'key', flat=True
+            ))
+            if colliding_values:
+                cls._collided(len(colliding_values), slug, generator_func)
+            keys |= {
+                candidate for candidate in candidates
+                if cls._get_unique_value(candidate, scope) not in colliding_values
+            }
+        return keys
+
     @property
     def is_valid(self):
         return (
             self.is_active and self.key and (self.expires_at is None or timezone.now() <= self.expires_at)
+            and not self.is_revoked
         )
 
+    @property
+    def is_revoked(self):
+        """
+        Token is revoked if setting GENERATION_REVOCATION is enabled and the generation of its object and slug was
+        incremented. Current generation is taken from the annotation (active, valid and manager lookups) or loaded
+        with a query once per instance.
+        """
+        if not settings.GENERATION_REVOCATION:
+            return False
+        if getattr(self, 'current_generation', None) is None:
+            self.current_generation = VerificationTokenGeneration.objects.get_generation_by_lookup(
+                content_type=self.content_type_id, object_id=str(self.object_id), slug=self.slug or ''
+            )
+        return self.generation < self.current_generation
+
+    @property
+    def raw_key(self):
+        """
+        Key which is sent to the user, key of the hashed token is known only after the key is set
+        """
+        return getattr(self, '_raw_key', None) if self.is_key_hashed else self.key
+
+    @property
+    def is_key_hashed(self):
+        return bool(self.selector) or bool(self.key) and self.key.startswith(HASHED_KEY_PREFIX)
+
+    def get_key_scope(self):
+        """
+        Returns lookup of the tokens among which the scoped key must be unique or None for globally unique key
+        """
+        return {
+            'content_type': self.content_type_id, 'object_id': str(self.object_id), 'slug': self.slug
+        } if self.is_key_scoped else None
+
+    def set_key(self, key):
+        """
+        Sets the key, only the selector and the digest of the key (only the digest of the scoped key) are stored if
+        the keys are hashed
+        """
+        if settings.HASHED_KEYS and self.is_key_scoped:
+            self.selector, self.key = None, self._get_scoped_key_digest(key)
+        elif settings.HASHED_KEYS:
+            self.selector, self.key = key[:SELECTOR_LENGTH], get_key_digest(key)
+        else:
+            self.key = key
+        self._raw_key = key
+
+    def matches_key(self, key):
+        """
+        Compares the key in constant time
+        """
+        if not key:
+            return False
+        elif self.selector:
+            return key[:SELECTOR_LENGTH] == self.selector and constant_time_compare(self.key, get_key_digest(key))
+        elif self.is_key_hashed:
+            return constant_time_compare(self.key, self._get_scoped_key_digest(key))
+        return constant_time_compare(self.key, key)
+
     def check_key(self, key):
         """
         Returns True if verification key is correct and not expired
         """
-        return self.is_valid and self.key == key
+        return self.is_valid and self.matches_key(key)
 
     def set_extra_data(self, extra_data):
-        self.extra_data = json.dumps(extra_data)
+        """
+        Kept for compatibility, extra data can be assigned to the JSON field directly
+        """
+        self.extra_data = extra_data
 
     def get_extra_data(self):
-        return json.loads(self.extra_data) if self.extra_data is not None else None
+        """
+        Kept for compatibility, JSON field is decoded once when the token is loaded from the database
+        """
+        return self.extra_data
+
+    def _insert_with_generated_key(self, key_generator_kwargs=None, first_key=None, **save_kwargs):
+        """
+        Insert token with a random key (or first_key) without checking its uniqueness first. If the key unique
+        constraint is violated the key is generated again and the insert is retried. Inside a transaction the insert
+        is wrapped in a savepoint, in autocommit mode the failed statement doesn't affect the connection.
+        """
+        key_generator_kwargs = dict(key_generator_kwargs or {})
+        generator_func = self.get_key_generator(key_generator_kwargs.pop('generator', None))
+        save_kwargs.pop('force_insert', None)
+        using = save_kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+
+        for i in range(settings.MAX_RANDOM_KEY_ITERATIONS):
+            self.set_key(first_key if i == 0 and first_key else self._generate_raw_key(
+                generator_func, self.get_key_scope(), **key_generator_kwargs
+            ))
+            try:
+                if transaction.get_connection(using).in_atomic_block:
+                    with transaction.atomic(using=using):
+                        super().save(force_insert=True, **save_kwargs)
+                else:
+                    super().save(force_insert=True, **save_kwargs)
+                return
+            except IntegrityError:
+                # error was not caused by the key collision
+                if not self._filter_colliding_tokens([self._raw_key], self.get_key_scope()).using(using).exists():
+                    raise
+                self._collided(1, self.slug, generator_func)
+        raise IntegrityError('Could not produce unique key for verification token')
 
     def save(self, *args, **kwargs):
-        if not self.key:
-            self.key = self.generate_key()
-        super().save(*args, **kwargs)
+        if not self.key and settings.OPTIMISTIC_KEY_GENERATION and self._state.adding and not args:
+            self._insert_with_generated_key(**kwargs)
+        else:
+            if not self.key:
+                self.set_key(self._generate_key(self.get_key_scope(), self.slug))
+            super().save(*args, **kwargs)
 
     def __str__(self):
         return self.key
 
     class Meta:
         ordering = ('-created_at',)
+        indexes = (
+            # filter_active_tokens ordered by created_at
+            models.Index(
+                fields=('content_type', 'object_id', 'slug', 'is_active', 'created_at'), name='vt_active_tokens_idx'
+            ),
+            # clean_verification_tokens
+            PartialIndex(fields=('expires_at',), name='vt_expires_at_idx', condition=Q(expires_at__isnull=False)),
+            PartialIndex(fields=('is_active',), name='vt_inactive_idx', condition=Q(is_active=False)),
+            # key lookups, unique constraints of the key are partial and don't match all key lookups
+            models.Index(fields=('key',), name='vt_key_idx'),
+        )
+        constraints = (
+            # full unique index of the key on databases without partial indexes (scoped keys are not supported there)
+            PartialUniqueConstraint(fields=('key',), condition=Q(is_key_scoped=False), name='vt_key_unique'),
+            # scoped keys (e.g. short SMS codes) are unique only among active tokens of the object and slug
+            models.UniqueConstraint(
+                fields=('content_type', 'object_id', 'slug', 'key'), condition=Q(is_key_scoped=True, is_active=True),
+                name='vt_scoped_key_unique'
+            ),
+        )
+
+
+class VerificationTokenGenerationManager(models.Manager.from_queryset(ReturningQuerySet)):
+
+    def _get_lookup(self, obj, slug=None):
+        return {
+            'content_type': ContentType.objects.get_for_model(obj.__class__),
+            'object_id': str(obj.pk),
+            'slug': slug or '',
+        }
+
+    def unused(self):
+        """
+        Returns generation rows which were only locked by get_active_or_create (never incremented) and whose object has
+        no active token with the slug. The rows are deleted by the command clean_verification_tokens.
+        """
+        active_tokens = VerificationToken.objects.annotate(generation_slug=Coalesce('slug', Value(''))).filter(
+            content_type=OuterRef('content_type'),
+            object_id=OuterRef('object_id'),
+            generation_slug=OuterRef('slug'),
+            is_active=True,
+        )
+        return self.filter(~Exists(active_tokens), generation=0)
+
+    def get_generation_by_lookup(self, **lookup):
+        return self.filter(**lookup).values_list('generation', flat=True).first() or 0
+
+    def get_generation(self, obj, slug=None):
+        return self.get_generation_by_lookup(**self._get_lookup(obj, slug))
+
+    def lock(self, obj, slug=None):
+        """
+        Locks the generation row of the object and slug until the end of the transaction (the row is created if it
+        doesn't exist). The lock is acquired by an update which doesn't change the generation, therefore it works on
+        databases without SELECT ... FOR UPDATE too. Returns True if the row was created by this call, rows which were
+        not incremented are removed by the command clean_verification_tokens.
+        """
+        lookup = self._get_lookup(obj, slug)
+        if self.filter(**lookup).update(generation=F('generation')):
+            return False
+        try:
+            with transaction.atomic(using=self.db):
+                self.create(**lookup)
+            return True
+        except IntegrityError:
+            # row was created by a concurrent request
+            self.filter(**lookup).update(generation=F('generation'))
+            return False
+
+    def _increment(self, lookup):
+        qs = self.filter(**lookup)
+        if qs._supports_update_returning():
+            rows = qs._update_returning(('generation',), generation=F('generation') + 1)
+            return rows[0][0] if rows else None
+        with transaction.atomic(using=self.db):
+            # the updated row is locked until the end of the transaction
+            return self.get_generation_by_lookup(**lookup) if qs.update(generation=F('generation') + 1) else None
+
+    def increment(self, obj, slug=None):
+        """
+        Increments the generation of the object and slug and returns the new generation. On databases with
+        UPDATE ... RETURNING support the existing row is incremented and read with one query.
+        """
+        lookup = self._get_lookup(obj, slug)
+        generation = self._increment(lookup)
+        if generation is None:
+            try:
+                with transaction.atomic(using=self.db):
+                    generation = self.create(generation=1, **lookup).generation
+            except IntegrityError:
+                # row was created by a concurrent request
+                generation = self._increment(lookup)
+        return generation
+
+
+class VerificationTokenGeneration(models.Model):
+    """
+    Generation counter of object tokens with the slug, incrementing the generation revokes all tokens issued before
+    """
+
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.TextField()
+    slug = models.SlugField(null=False, blank=True, default='')
+    generation = models.PositiveIntegerField(null=False, blank=False, default=0)
+
+    objects = VerificationTokenGenerationManager()
+
+    def __str__(self):
+        return '{}:{}:{}'.format(self.content_type_id, self.object_id, self.slug)
+
+    class Meta:
+        unique_together = ('content_type', 'object_id', 'slug')
+
+
+# reserved keys claimed by the process per database alias
+_claimed_reserved_keys = defaultdict(deque)
+
+
+class VerificationTokenReservedKeyManager(models.Manager):
+
+    def _claim(self, count):
+        """
+        Removes up to count reserved keys from the reservoir and returns them. Keys are removed with one
+        DELETE ... RETURNING where supported, otherwise they are selected for update and deleted in a transaction.
+        """
+        qs = self.get_queryset()
+        connection = connections[qs.db]
+        skip_locked = connection.features.has_select_for_update_skip_locked
+        if _supports_returning(connection):
+            table, pk, key = (
+                connection.ops.quote_name(name) for name in (self.model._meta.db_table, 'id', 'key')
+            )
+            subquery = 'SELECT {pk} FROM {table} ORDER BY {pk} LIMIT %s{lock}'.format(
+                pk=pk, table=table, lock=' FOR UPDATE SKIP LOCKED' if skip_locked else ''
+            )
+            with connection.cursor() as cursor:
+                cursor.execute('DELETE FROM {table} WHERE {pk} IN ({subquery}) RETURNING {pk}, {key}'.format(
+                    table=table, pk=pk, subquery=subquery, key=key
+                ), [count])
+                return [key for _, key in sorted(cursor.fetchall())]
+
+        with transaction.atomic(using=qs.db):
+            # locked keys can't be claimed by a concurrent request
+            rows = list(qs.select_for_update(skip_locked=skip_locked).order_by('pk').values_list('pk', 'key')[:count])
+            qs.filter(pk__in=[pk for pk, _ in rows]).delete()
+        return [key for _, key in rows]
+
+    def pop(self):
+        """
+        Returns one reserved key or None if the reservoir is empty. Keys are claimed from the reservoir in batches of
+        KEY_RESERVOIR_CLAIM_SIZE with one query and the rest of the batch is kept in the process memory, most of the
+        pops therefore don't query the database. Claimed keys which are not used before the process ends are lost.
+        """
+        claimed_keys = _claimed_reserved_keys[self.db]
+        try:
+            return claimed_keys.popleft()
+        except IndexError:
+            pass
+
+        keys = self._claim(settings.KEY_RESERVOIR_CLAIM_SIZE)
+        if not keys:
+            metrics.incr('key_reservoir.empty')
+            return None
+        claimed_keys.extend(keys[1:])
+        return keys[0]
+
+    def clear_claimed(self):
+        """
+        Forgets reserved keys claimed by the process, the keys are not returned to the reservoir.
+        """
+        _claimed_reserved_keys[self.db].clear()
+
+    def fill(self, size, batch_size=1000):
+        """
+        Adds keys generated with the default generator settings until the reservoir contains size keys. Keys are
+        unique across tokens and reserved keys. Returns the reservoir depth.
+        """
+        depth = self.count()
+        while depth < size:
+            keys = VerificationToken.generate_keys(min(batch_size, size - depth))
+            self.bulk_create([self.model(key=key) for key in keys], ignore_conflicts=True)
+            depth = self.count()
+        metrics.gauge('key_reservoir.depth', depth)
+        return depth
+
+
+class VerificationTokenReservedKey(models.Model):
+    """
+    Pre-generated unique key which is used by the next issued token
+    """
+
+    key = models.CharField(max_length=100, null=False, blank=False, unique=True)
+
+    objects = VerificationTokenReservedKeyManager()
+
+    def __str__(self):
+        return self.key
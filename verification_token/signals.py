@@ -0,0 +1,19 @@
+from django.dispatch import Signal
+
+
+VERIFICATION_HIT = 'hit'
+VERIFICATION_MISS = 'miss'
+VERIFICATION_EXPIRED = 'expired'
+
+# Sent with argument tokens (list of issued tokens)
+token_issued = Signal()
+
+# Sent with arguments obj, slug, key and result (VERIFICATION_HIT, VERIFICATION_MISS or VERIFICATION_EXPIRED)
+token_verified = Signal()
+
+# Sent with arguments obj, slug, key and count (number of deactivated tokens)
+token_deactivated = Signal()
+
+# Sent with arguments slug, live_token_count, keyspace_size, expected_retries and adapted_length (increased key length
+# or None) when expected number of key generator retries exceeds setting KEYSPACE_RETRIES_THRESHOLD
+keyspace_exhausting = Signal()
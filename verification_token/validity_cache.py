@@ -0,0 +1,183 @@
+import hashlib
+import math
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from . import metrics
+from .config import settings
+from .signals import VERIFICATION_EXPIRED, VERIFICATION_HIT
+
+
+PREFIX = 'verification_token:validity'
+
+# object id of the version key which invalidates cached results of all objects of the model class
+CLASS_OBJECT_ID = '*'
+
+
+def is_enabled():
+    return settings.VALIDITY_CACHE
+
+
+def _get_cache():
+    return caches[settings.VALIDITY_CACHE_ALIAS]
+
+
+def _get_version_key(content_type_id, object_id, slug):
+    return '{}:version:{}:{}:{}'.format(PREFIX, content_type_id, object_id, slug or '')
+
+
+def _get_version_keys(content_type_id, object_id, slug):
+    return (
+        _get_version_key(content_type_id, object_id, slug),
+        _get_version_key(content_type_id, CLASS_OBJECT_ID, slug),
+    )
+
+
+def _get_entry_key(content_type_id, object_id, slug, key):
+    # keys are not stored in the cache in the readable form
+    return '{}:entry:{}'.format(PREFIX, hashlib.sha256('{}:{}:{}:{}'.format(
+        content_type_id, object_id, slug or '', key
+    ).encode()).hexdigest())
+
+
+def _get_new_version():
+    # random version is never reused, therefore evicted version key can't validate an old entry
+    return get_random_string(12)
+
+
+def _get_missing_version_keys(values, version_keys):
+    return [version_key for version_key in version_keys if values.get(version_key) is None]
+
+
+def _get_seed_versions(missing_version_keys):
+    return {version_key: _get_new_version() for version_key in missing_version_keys}
+
+
+def _get_versions(cache, values, version_keys):
+    """
+    Returns versions of the object and class tokens and whether all of them were cached. Missing version (never set,
+    evicted or expired) is seeded with a random value with add, entries stored before therefore can't match it.
+    """
+    missing_version_keys = _get_missing_version_keys(values, version_keys)
+    if missing_version_keys:
+        for version_key, version in _get_seed_versions(missing_version_keys).items():
+            cache.add(version_key, version, None)
+        # version could be seeded by a concurrent request
+        values = {**values, **cache.get_many(missing_version_keys)}
+    return tuple(values.get(version_key) for version_key in version_keys), not missing_version_keys
+
+
+async def _aget_versions(cache, values, version_keys):
+    missing_version_keys = _get_missing_version_keys(values, version_keys)
+    if missing_version_keys:
+        for version_key, version in _get_seed_versions(missing_version_keys).items():
+            await cache.aadd(version_key, version, None)
+        values = {**values, **await cache.aget_many(missing_version_keys)}
+    return tuple(values.get(version_key) for version_key in version_keys), not missing_version_keys
+
+
+def _get_cached_result(entry, version, is_version_cached, slug):
+    """
+    Returns cached verification result (or None) and version of the tokens. Entry is valid only if it was stored with
+    the current version of the object and class tokens, missing version is always a cache miss.
+    """
+    if not is_version_cached or entry is None or tuple(entry[0]) != version:
+        metrics.incr('validity_cache.miss', slug=slug)
+        return None, version
+
+    metrics.incr('validity_cache.hit', slug=slug)
+    _, result, expires_at = entry
+    if result == VERIFICATION_HIT and expires_at is not None and expires_at < timezone.now().timestamp():
+        result = VERIFICATION_EXPIRED
+    return result, version
+
+
+def _get_entry(version, result, expires_at):
+    """
+    Returns entry value and its timeout. Valid token is cached for its remaining lifetime, missing and expired tokens
+    for VALIDITY_CACHE_NEGATIVE_TIMEOUT seconds (None means negative results are not cached).
+    """
+    if result != VERIFICATION_HIT:
+        negative_timeout = settings.VALIDITY_CACHE_NEGATIVE_TIMEOUT
+        return (version, result, None), negative_timeout
+    if expires_at is None:
+        return (version, result, None), DEFAULT_TIMEOUT
+    timeout = math.ceil((expires_at - timezone.now()).total_seconds())
+    return (version, result, expires_at.timestamp()), timeout if timeout > 0 else None
+
+
+def get(content_type_id, object_id, slug, key):
+    """
+    Returns cached verification result of the key (None if it isn't cached) and version which must be used for
+    storing the result. Versions and the entry are loaded with one get_many.
+    """
+    cache = _get_cache()
+    version_keys = _get_version_keys(content_type_id, object_id, slug)
+    entry_key = _get_entry_key(content_type_id, object_id, slug, key)
+    values = cache.get_many((*version_keys, entry_key))
+    return _get_cached_result(values.get(entry_key), *_get_versions(cache, values, version_keys), slug)
+
+
+async def aget(content_type_id, object_id, slug, key):
+    cache = _get_cache()
+    version_keys = _get_version_keys(content_type_id, object_id, slug)
+    entry_key = _get_entry_key(content_type_id, object_id, slug, key)
+    values = await cache.aget_many((*version_keys, entry_key))
+    return _get_cached_result(values.get(entry_key), *await _aget_versions(cache, values, version_keys), slug)
+
+
+def store(content_type_id, object_id, slug, key, version, result, expires_at=None):
+    entry, timeout = _get_entry(version, result, expires_at)
+    if timeout is not None:
+        _get_cache().set(_get_entry_key(content_type_id, object_id, slug, key), entry, timeout)
+
+
+async def astore(content_type_id, object_id, slug, key, version, result, expires_at=None):
+    entry, timeout = _get_entry(version, result, expires_at)
+    if timeout is not None:
+        await _get_cache().aset(_get_entry_key(content_type_id, object_id, slug, key), entry, timeout)
+
+
+def _get_token_entry(token, version):
+    entry, timeout = _get_entry(version, VERIFICATION_HIT, token.expires_at)
+    return _get_entry_key(token.content_type_id, token.object_id, token.slug, token.raw_key), entry, timeout
+
+
+def write_through(token):
+    """
+    Stores the issued token as valid, negative result of the same key cached before is overwritten.
+    """
+    cache = _get_cache()
+    version_keys = _get_version_keys(token.content_type_id, token.object_id, token.slug)
+    version, _ = _get_versions(cache, cache.get_many(version_keys), version_keys)
+    entry_key, entry, timeout = _get_token_entry(token, version)
+    if timeout is not None:
+        cache.set(entry_key, entry, timeout)
+
+
+async def awrite_through(token):
+    cache = _get_cache()
+    version_keys = _get_version_keys(token.content_type_id, token.object_id, token.slug)
+    version, _ = await _aget_versions(cache, await cache.aget_many(version_keys), version_keys)
+    entry_key, entry, timeout = _get_token_entry(token, version)
+    if timeout is not None:
+        await cache.aset(entry_key, entry, timeout)
+
+
+def _get_new_versions(content_type_id, object_ids, slug):
+    return {_get_version_key(content_type_id, object_id, slug): _get_new_version() for object_id in object_ids}
+
+
+def invalidate(content_type_id, object_ids, slug):
+    """
+    Invalidates cached results of the objects tokens (CLASS_OBJECT_ID invalidates tokens of all objects) by changing
+    their versions, entries stored concurrently with the old version are invalid too.
+    """
+    _get_cache().set_many(_get_new_versions(content_type_id, object_ids, slug), None)
+
+
+async def ainvalidate(content_type_id, object_ids, slug):
+    await _get_cache().aset_many(_get_new_versions(content_type_id, object_ids, slug), None)